@@ -10,6 +10,9 @@ load_dotenv(os.path.join(BASE_DIR, '.env'))
 sys.path.append(BASE_DIR)
 
 # import jwt
+import json
+import base64
+import asyncio
 import shutil
 import tweepy
 import uvicorn
@@ -18,6 +21,12 @@ from pydantic import BaseModel
 from fastapi import FastAPI, HTTPException, Request, Response, responses, Depends, status
 # from fastapi_sqlalchemy import DBSessionMiddleware, db
 from fastapi.middleware.cors import CORSMiddleware
+from storage import open_storage
+from user_store import UserStore
+import twt_client
+from twt_client import get_user_api, new_api, run_twt
+from follow_scheduler import FollowScheduler
+import session_token
 
 logger = logging.getLogger("fans")
 app = FastAPI()
@@ -27,7 +36,9 @@ origins = ("http://localhost:8000", "http://localhost", "*")
 app.add_middleware(CORSMiddleware,
                    allow_origins=origins,
                    allow_methods=['*'],
-                   allow_headers=['*'])
+                   allow_headers=['*'],
+                   # browsers hide other response headers from cross-origin scripts
+                   expose_headers=['X-Next-Cursor'])
 
 # to avoid csrftokenError
 # app.add_middleware(DBSessionMiddleware, db_url=os.environ['DATABASE_URL'])
@@ -36,15 +47,23 @@ twt_api = None
 # twt_login_callback = "http://127.0.0.1:8000/login_callback"
 twt_login_callback = "https://fans3-server-46szvdni7q-uc.a.run.app/login_callback"
 cookie_key = "fans-cookie"
-cookie_cache = {}
-user_table = {}
-oauth_cache = {}
+# `:memory:` keeps everything in process, otherwise a SQLite file shared by all workers.
+# It must be on a persistent disk, a container filesystem is lost on every restart.
+FANS_DB = os.environ.get("FANS_DB", os.path.join(BASE_DIR, "fans.db"))
+storage = open_storage(FANS_DB)
+# pending OAuth handshakes, abandoned ones expire and the table stays bounded
+OAUTH_TTL = float(os.environ.get("OAUTH_TTL", "600"))
+OAUTH_MAX_PENDING = int(os.environ.get("OAUTH_MAX_PENDING", "10000"))
+OAUTH_SWEEP_INTERVAL = float(os.environ.get("OAUTH_SWEEP_INTERVAL", "30"))
+oauth_cache = storage.expiring_table("oauth", OAUTH_TTL, OAUTH_MAX_PENDING)
+follow_scheduler = FollowScheduler(storage)
 
 def get_twt_auth():
-    print("secret env", os.environ["CONSUMER_KEY"], os.environ["CONSUMER_SECRET"])
-    return tweepy.OAuth1UserHandler(os.environ["CONSUMER_KEY"],
-                                    os.environ["CONSUMER_SECRET"],
-                                    callback=twt_login_callback)
+    return twt_client.get_twt_auth(callback=twt_login_callback)
+
+async def db(fn, *args):
+    """Run a storage call in a thread, a SQLite write may wait on another worker's lock"""
+    return await asyncio.to_thread(fn, *args)
 
 # -------------- models & sechmas --------------------
 class User(BaseModel):
@@ -55,12 +74,30 @@ class User(BaseModel):
     address: str = None
 
 
+user_table = UserStore(storage, User)
+
+
+class Session(BaseModel):
+    name: str
+    t_id: int
+
+
 class FollowReq(BaseModel):
     address: str = None
     subject: str = None
     subject_tid: str = None # for test
     subject_name:str = None # for test
 
+class FollowBatchReq(BaseModel):
+    subjects: list[str]  # addresses of the subjects
+
+class FollowJobResp(BaseModel):
+    job_id: str
+    status: str
+    total: int
+    followed: list[str]
+    failed: dict[str, str]
+
 class UserReq(BaseModel):
     address: str = None
 
@@ -81,25 +118,20 @@ def _get_user(
         # headers={"WWW-Authenticate": "Bearer"},
     )
     if req.address:
-        for user in user_table:
-            if user_table[user].address == req.address:
-                return user_table[user]
-        return None
+        return user_table.get_by_address(req.address)
     else:
-        subject_user = user_table.get(req.subject)
+        subject_user = user_table.get_by_name(req.subject)
         if subject_user is None:
             raise credentials_exception
         return subject_user
 
 
-def get_current_user(request: Request):
-    cookie = request.cookies.get(cookie_key)
-    if cookie is None:
-        pass
-    user = user_table.get(cookie)
-    if user is None:
-        pass
-    return user
+def get_current_user(request: Request) -> Session | None:
+    # the signed cookie carries the session, no lookup needed to check it
+    claims = session_token.verify(request.cookies.get(cookie_key))
+    if claims is None:
+        return None
+    return Session(name=claims["name"], t_id=claims["t_id"])
 
 # ------------------ routers & apis ------------------------
 # router and models examples
@@ -109,16 +141,15 @@ async def root():
 
 @app.get('/login', response_class=responses.RedirectResponse)
 async def login(address : str, request: Request):
-    cookie = request.cookies.get(cookie_key)
-    if cookie and cookie_cache.get(cookie) is not None:
-        print("find cookie" , cookie)
+    if get_current_user(request) is not None:
         return responses.RedirectResponse("/")
     else:
         twt_auth = get_twt_auth()
-        redirect_url = twt_auth.get_authorization_url()
+        redirect_url = await run_twt(twt_auth.get_authorization_url)
         oauth_tokens = twt_auth.oauth.token.get("oauth_token")
-        oauth_cache[oauth_tokens] = twt_auth.request_token
-        oauth_cache[oauth_tokens]["address"] = address
+        request_token = dict(twt_auth.request_token)
+        request_token["address"] = address
+        await db(oauth_cache.set, oauth_tokens, request_token)
         return responses.RedirectResponse(redirect_url)
 
 # called by twitter
@@ -130,59 +161,128 @@ async def login_callback(request: Request, response:Response, oauth_token:str =
     print("oauth_verifier", oauth_verifier)
 
     twt_auth = get_twt_auth()
-    request_token = oauth_cache.get(oauth_token, None)
+    # deleted as it's read, a token can only be redeemed once
+    request_token = await db(oauth_cache.pop, oauth_token)
     if request_token is None:
         return "failed"
     twt_auth.request_token = request_token
     user_address = request_token["address"]
-    oauth_cache.pop(oauth_token)
 
-    ak, sk = twt_auth.get_access_token(oauth_verifier)
-    api = tweepy.API(twt_auth)
-    t_user: tweepy.User = api.verify_credentials()# To run locally
+    ak, sk = await run_twt(twt_auth.get_access_token, oauth_verifier)
+    api = new_api(twt_auth)
+    t_user: tweepy.User = await run_twt(api.verify_credentials)# To run locally
     user = User(name=t_user.screen_name, t_id=t_user.id, ak=ak, sk=sk, address=user_address)
-    cookie_cache[user.name] = user
-    user_table[user.name] = user
-    response.set_cookie(key=cookie_key, value=user.name)
+    await db(user_table.put, user)
+    response.set_cookie(
+        key=cookie_key,
+        value=session_token.issue({"name": user.name, "t_id": user.t_id}),
+        max_age=session_token.SESSION_TTL,
+        httponly=True,
+    )
 
     return f"get authentication of user: {user.name}, {user.t_id}, {user.address}"
 
+def _encode_cursor(key: str) -> str:
+    return base64.urlsafe_b64encode(key.encode()).decode()
+
+def _decode_cursor(cursor: str) -> str:
+    try:
+        return base64.urlsafe_b64decode(cursor.encode()).decode()
+    except ValueError:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="bad cursor")
+
+def _stream_users(after: str | None):
+    for user in user_table.values(after):
+        yield json.dumps({"address": user.address, "name": user.name, "t_id": user.t_id}) + "\n"
+
+# pages are ordered by user key, pass back `X-Next-Cursor` to get the next one.
+# `stream=true` writes every user as NDJSON without building the whole list.
 @app.get("/users", response_model=list[UserResp])
-async def get_users():
-    resp = [user_table[user] for user in user_table]
-    return resp
+async def get_users(response: Response, limit: int = 100, cursor: str = None, stream: bool = False):
+    after = None if cursor is None else _decode_cursor(cursor)
+    if stream:
+        # sync generator, starlette iterates it in a thread pool
+        return responses.StreamingResponse(_stream_users(after), media_type="application/x-ndjson")
+    users, next_key = await db(user_table.page, after, max(1, min(limit, 1000)))
+    if next_key is not None:
+        response.headers["X-Next-Cursor"] = _encode_cursor(next_key)
+    return users
 
 @app.get("/user", response_model=UserResp | None)
 async def get_user(address:str):
-    user = _get_user(UserReq(address=address))
+    user = await db(_get_user, UserReq(address=address))
     return user
 
 
 @app.post("/follow")
 async def follow(
-    request: Request,
-    user: User = Depends(get_current_user),
+    session: Session = Depends(get_current_user),
     subject_user: User = Depends(_get_user)
 ):
-    print(user, subject_user)
-    cookie = request.cookies.get(cookie_key)
-    if cookie is None or cookie_cache.get(cookie) is None:
+    print(session, subject_user)
+    user: User = session and await db(user_table.get, session.t_id)
+    if user is None:
         return responses.RedirectResponse("/login")
 
-    user: User = cookie_cache.get(cookie)
-
-    twt_auth = get_twt_auth()
-    twt_auth.set_access_token(user.ak, user.sk)
-    api = tweepy.API(twt_auth)
+    api = get_user_api(user.ak, user.sk)
 
     # resp_user = api.create_friendship(screen_name=subject_user.name, subject_user.t_id)
-    resp_user = api.create_friendship(screen_name=subject_user.name)
+    resp_user = await run_twt(api.create_friendship, screen_name=subject_user.name)
     print(resp_user)
 
 
+@app.post("/follow/batch", response_model=FollowJobResp)
+async def follow_batch(req: FollowBatchReq, session: Session = Depends(get_current_user)):
+    user: User = session and await db(user_table.get, session.t_id)
+    if user is None:
+        return responses.RedirectResponse("/login")
+
+    subjects, missing = [], []
+    addresses = list(dict.fromkeys(req.subjects))
+    found = await db(lambda: [user_table.get_by_address(a) for a in addresses])
+    for address, subject_user in zip(addresses, found):
+        if subject_user is None:
+            missing.append(address)
+        else:
+            subjects.append(subject_user)
+    return await follow_scheduler.submit(user, subjects, missing)
+
+@app.get("/follow/batch/{job_id}", response_model=FollowJobResp)
+async def follow_batch_status(job_id: str):
+    job = await db(follow_scheduler.get_job, job_id)
+    if job is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="job not found")
+    return job
+
+
 @app.post("/unfollow")
 async def unfollow(request: Request, subject: str):
     pass
 
+async def sweep_oauth_cache():
+    while True:
+        await asyncio.sleep(OAUTH_SWEEP_INTERVAL)
+        try:
+            expired = await asyncio.to_thread(oauth_cache.sweep)
+            if expired:
+                logger.info("oauth cache swept %d, stats %s", expired, oauth_cache.stats())
+            expired = await asyncio.to_thread(follow_scheduler.jobs.sweep)
+            if expired:
+                logger.info("follow jobs swept %d", expired)
+        except Exception:
+            logger.exception("oauth cache sweep failed")
+
+@app.on_event("startup")
+async def start_sweeper():
+    interrupted = await asyncio.to_thread(follow_scheduler.recover)
+    if interrupted:
+        logger.info("failed %d follow jobs interrupted by a restart", interrupted)
+    app.state.oauth_sweeper = asyncio.create_task(sweep_oauth_cache())
+
+@app.on_event("shutdown")
+def close_storage():
+    app.state.oauth_sweeper.cancel()
+    storage.close()
+
 if __name__ == '__main__':
     uvicorn.run(app, host='0.0.0.0', port=8000)
\ No newline at end of file
@@ -0,0 +1,173 @@
+"""Rate-limit-aware scheduler for bulk follows.
+
+Each access token gets its own queue drained by one worker task, which tracks the
+twitter rate-limit budget of that token and sleeps until the window resets instead of
+dropping follows. Job progress is kept in storage so any worker can report it, for
+FOLLOW_JOB_TTL seconds after its last update.
+"""
+
+import asyncio
+import logging
+import os
+import time
+import uuid
+
+import tweepy
+from fastapi import HTTPException
+
+from storage import Storage
+from twt_client import get_user_api, run_twt
+
+logger = logging.getLogger("fans")
+
+# twitter rate-limit windows are 15 minutes, used when a 429 carries no reset time
+RATE_LIMIT_WINDOW = 15 * 60
+# attempts for a follow failing with a timeout or twitter server error
+MAX_ATTEMPTS = 3
+# seconds a job is kept after its last update, and max jobs kept
+FOLLOW_JOB_TTL = float(os.environ.get("FOLLOW_JOB_TTL", "86400"))
+FOLLOW_JOB_MAX = int(os.environ.get("FOLLOW_JOB_MAX", "100000"))
+
+
+class RateBudget:
+    """Remaining twitter rate-limit budget of one access token"""
+
+    def __init__(self):
+        self.remaining = None
+        self.reset_at = 0.0
+
+    def update(self, response):
+        if response is None:
+            return
+        remaining = response.headers.get("x-rate-limit-remaining")
+        reset = response.headers.get("x-rate-limit-reset")
+        if remaining is not None:
+            self.remaining = int(remaining)
+        if reset is not None:
+            self.reset_at = float(reset)
+
+    def exhaust(self, response):
+        self.update(response)
+        self.remaining = 0
+        if self.reset_at <= time.time():
+            self.reset_at = time.time() + RATE_LIMIT_WINDOW
+
+    def delay(self) -> float:
+        if self.remaining is None or self.remaining > 0:
+            return 0
+        return max(0.0, self.reset_at - time.time())
+
+
+class FollowScheduler:
+    def __init__(self, storage: Storage):
+        self.jobs = storage.expiring_table(
+            "follow_job", FOLLOW_JOB_TTL, FOLLOW_JOB_MAX
+        )
+        self._queues = {}
+        self._budgets = {}
+        self._workers = {}
+
+    async def submit(self, user, subjects: list, missing: list[str]) -> dict:
+        """Queue follows of `subjects` for `user`, `missing` are subjects not found"""
+        job = {
+            "job_id": uuid.uuid4().hex,
+            "status": "running" if subjects else "done",
+            "total": len(subjects) + len(missing),
+            "followed": [],
+            "failed": {address: "subject user not found" for address in missing},
+            "created_at": time.time(),
+            "subjects": [subject.address for subject in subjects],
+            # the process following, its queue is lost if it dies
+            "pid": os.getpid(),
+        }
+        await asyncio.to_thread(self.jobs.set, job["job_id"], job)
+        if not subjects:
+            return job
+        queue = self._queues.setdefault(user.ak, asyncio.Queue())
+        for subject in subjects:
+            queue.put_nowait((job["job_id"], subject))
+        if user.ak not in self._workers:
+            self._workers[user.ak] = asyncio.create_task(self._work(user, queue))
+        return job
+
+    def get_job(self, job_id: str) -> dict | None:
+        return self.jobs.get(job_id)
+
+    def recover(self) -> int:
+        """Fail jobs left running by a process that is gone, call once on startup"""
+        interrupted = 0
+        for job_id, job in self.jobs.items():
+            if job["status"] != "running" or _alive(job.get("pid")):
+                continue
+            for address in job.get("subjects", []):
+                if address not in job["followed"] and address not in job["failed"]:
+                    job["failed"][address] = "interrupted by a server restart"
+            job["status"] = "failed"
+            self.jobs.set(job_id, job)
+            interrupted += 1
+        return interrupted
+
+    async def _work(self, user, queue: asyncio.Queue):
+        try:
+            while not queue.empty():
+                job_id, subject = queue.get_nowait()
+                error = await self._follow(user, subject)
+                await asyncio.to_thread(self._record, job_id, subject.address, error)
+        except Exception:
+            logger.exception("follow worker of %s crashed", user.name)
+        finally:
+            # nothing awaits between the empty check and here, so no follow is lost
+            self._workers.pop(user.ak, None)
+            self._queues.pop(user.ak, None)
+            self._budgets.pop(user.ak, None)
+
+    async def _follow(self, user, subject) -> str | None:
+        """Follow one subject, returns an error message if it finally failed"""
+        budget = self._budgets.setdefault(user.ak, RateBudget())
+        api = get_user_api(user.ak, user.sk)
+        attempts = 0
+        while True:
+            delay = budget.delay()
+            if delay > 0:
+                logger.info("%s is rate limited for %.0fs", user.name, delay)
+                await asyncio.sleep(delay)
+            try:
+                await run_twt(api.create_friendship, screen_name=subject.name)
+            except tweepy.TooManyRequests as e:
+                budget.exhaust(e.response)
+                continue
+            except (tweepy.TwitterServerError, HTTPException) as e:
+                attempts += 1
+                if attempts >= MAX_ATTEMPTS:
+                    return str(e)
+                await asyncio.sleep(2**attempts)
+                continue
+            except tweepy.TweepyException as e:
+                return str(e)
+            budget.update(api.last_response)
+            return None
+
+    def _record(self, job_id: str, address: str, error: str | None):
+        job = self.jobs.get(job_id)
+        if job is None:
+            return
+        if error is None:
+            job["followed"].append(address)
+        else:
+            job["failed"][address] = error
+        if len(job["followed"]) + len(job["failed"]) >= job["total"]:
+            job["status"] = "done"
+        self.jobs[job_id] = job
+
+
+def _alive(pid: int | None) -> bool:
+    """Whether another process with this pid runs on this host"""
+    if pid is None or pid == os.getpid():
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+"""
+Load test: latency of `/` and `/users` while `/follow` waits on a slow twitter.
+
+Runs the server in process on an in-memory store, with twitter replaced by a sleep of
+`--twitter-delay` seconds, then hammers `/follow` from `--follow-clients` threads while
+`--clients` threads measure `/` and `/users`:
+```
+python3 ./load_test.py --twitter-delay 5 --follow-clients 64 --duration 30
+```
+Slow follows should only answer 503/504 once TWT_MAX_CONCURRENCY is used up, the p99
+of `/` and `/users` should stay in milliseconds.
+"""
+
+import argparse
+import os
+import threading
+import time
+from collections import Counter
+
+os.environ["FANS_DB"] = ":memory:"
+os.environ.setdefault("SESSION_KEYS", "load:load-test")
+os.environ.setdefault("CONSUMER_KEY", "load")
+os.environ.setdefault("CONSUMER_SECRET", "load")
+
+import requests
+import tweepy
+import uvicorn
+
+import fans_server
+import session_token
+
+
+def start_server(port: int, twitter_delay: float, users: int):
+    def slow_twitter(self, *args, **kwargs):
+        time.sleep(twitter_delay)
+
+    tweepy.API.create_friendship = slow_twitter
+    for i in range(users):
+        fans_server.user_table.put(
+            fans_server.User(
+                name=f"user{i}",
+                t_id=i + 1,
+                ak=f"ak{i}",
+                sk=f"sk{i}",
+                address=f"0x{i:040x}",
+            )
+        )
+    server = uvicorn.Server(
+        uvicorn.Config(fans_server.app, port=port, log_level="warning")
+    )
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    return server
+
+
+def percentile(samples: list[float], p: float) -> float:
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * p))] * 1000
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--twitter-delay", type=float, default=5)
+    parser.add_argument("--follow-clients", type=int, default=64)
+    parser.add_argument("--clients", type=int, default=8)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--duration", type=float, default=30)
+    args = parser.parse_args()
+
+    server = start_server(args.port, args.twitter_delay, args.users)
+    base = f"http://127.0.0.1:{args.port}"
+    deadline = time.monotonic() + args.duration
+    latencies = {"/": [], "/users": []}
+    statuses = Counter()
+    lock = threading.Lock()
+
+    def follower(i: int):
+        session = requests.Session()
+        cookie = session_token.issue({"name": f"user{i}", "t_id": i + 1})
+        session.cookies.set(fans_server.cookie_key, cookie)
+        while time.monotonic() < deadline:
+            resp = session.post(
+                f"{base}/follow",
+                json={"address": f"0x{(i + 1) % args.users:040x}"},
+            )
+            with lock:
+                statuses[f"/follow {resp.status_code}"] += 1
+
+    def reader():
+        session = requests.Session()
+        while time.monotonic() < deadline:
+            for path in latencies:
+                started = time.monotonic()
+                resp = session.get(f"{base}{path}")
+                elapsed = time.monotonic() - started
+                with lock:
+                    latencies[path].append(elapsed)
+                    statuses[f"{path} {resp.status_code}"] += 1
+
+    threads = [
+        threading.Thread(target=follower, args=(i % args.users,))
+        for i in range(args.follow_clients)
+    ] + [threading.Thread(target=reader) for _ in range(args.clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    server.should_exit = True
+
+    for path, samples in latencies.items():
+        print(
+            f"{path}: {len(samples)} requests,"
+            f" p50 {percentile(samples, 0.5):.1f}ms p99 {percentile(samples, 0.99):.1f}ms"
+        )
+    print(f"status codes: {dict(statuses)}")
+
+
+if __name__ == "__main__":
+    main()
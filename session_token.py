@@ -0,0 +1,92 @@
+"""Signed, self-contained session tokens for fans_server.
+
+A token is `<kid>.<payload>.<signature>`, the payload is base64url JSON claims and the
+signature an HMAC-SHA256 over kid and payload. Any worker holding the keys verifies a
+token locally, no shared session store needed.
+
+Keys come from `SESSION_KEYS` as `kid:secret` pairs separated by commas. The first key
+signs new tokens, all of them verify, so a key is rotated by prepending a new one and
+dropping the old one once its tokens expired.
+"""
+
+import base64
+import hashlib
+import hmac
+import json
+import logging
+import os
+import secrets
+import time
+
+logger = logging.getLogger("fans")
+
+SESSION_TTL = int(os.environ.get("SESSION_TTL", str(30 * 24 * 3600)))
+# secret of the example config, published, anyone could sign sessions with it
+PLACEHOLDER_SECRET = b"change-me"
+
+
+def _load_keys(spec: str | None) -> dict[str, bytes]:
+    keys = {}
+    for pair in (spec or "").split(","):
+        kid, sep, secret = pair.strip().partition(":")
+        if sep and kid and secret:
+            keys[kid] = secret.encode()
+    if PLACEHOLDER_SECRET in keys.values():
+        raise RuntimeError(
+            "SESSION_KEYS still holds the example secret, set a random one, e.g."
+            " `python -c 'import secrets; print(secrets.token_urlsafe(32))'`"
+        )
+    if not keys:
+        logger.warning(
+            "SESSION_KEYS not set, sessions won't survive restarts or work across workers"
+        )
+        keys["dev"] = secrets.token_bytes(32)
+    return keys
+
+
+_keys = _load_keys(os.environ.get("SESSION_KEYS"))
+_signing_kid = next(iter(_keys))
+
+
+def _b64encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+
+def _b64decode(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+
+def _sign(kid: str, payload: str) -> str:
+    return _b64encode(
+        hmac.new(_keys[kid], f"{kid}.{payload}".encode(), hashlib.sha256).digest()
+    )
+
+
+def issue(claims: dict, ttl: int = SESSION_TTL) -> str:
+    """Sign `claims` into a token expiring in `ttl` seconds"""
+    payload = _b64encode(
+        json.dumps({**claims, "exp": int(time.time()) + ttl}).encode()
+    )
+    return f"{_signing_kid}.{payload}.{_sign(_signing_kid, payload)}"
+
+
+def verify(token: str | None) -> dict | None:
+    """Claims of a valid, unexpired token, None otherwise"""
+    if not token:
+        return None
+    try:
+        kid, payload, signature = token.split(".")
+    except ValueError:
+        return None
+    # compared as bytes, compare_digest raises TypeError on non-ASCII str
+    if kid not in _keys or not hmac.compare_digest(
+        signature.encode(), _sign(kid, payload).encode()
+    ):
+        return None
+    try:
+        claims = json.loads(_b64decode(payload))
+    except ValueError:
+        return None
+    if not isinstance(claims, dict) or claims.get("exp", 0) <= time.time():
+        return None
+    return claims
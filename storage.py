@@ -0,0 +1,538 @@
+"""Pluggable key/value storage for fans_server tables.
+
+Values are JSON-serializable objects stored under (table, key), optionally with a ttl
+after which they read as missing until swept. `MemoryStorage` is for tests and local
+runs, `SqliteStorage` is shared by every uvicorn worker on the host and survives
+restarts as long as its file lives on a persistent disk. Wrap either in `CachedStorage`
+for an in-process read-through cache.
+
+Calls block, SQLite writes may wait on another worker's lock for up to 30 seconds, so
+async code runs them in a thread.
+"""
+
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+class Storage:
+    """Base interface of a storage backend"""
+
+    def get(self, table: str, key: str):
+        raise NotImplementedError
+
+    def put(self, table: str, key: str, value, ttl: float = None):
+        raise NotImplementedError
+
+    def delete(self, table: str, key: str):
+        raise NotImplementedError
+
+    def pop(self, table: str, key: str):
+        """Delete an entry and return its value, None if missing, in one atomic step"""
+        raise NotImplementedError
+
+    def items(self, table: str, after: str = None, limit: int = None):
+        """Iterate (key, value) of a table ordered by key, starting after key `after`"""
+        raise NotImplementedError
+
+    def count(self, table: str) -> int:
+        raise NotImplementedError
+
+    def sweep(self, table: str) -> int:
+        """Delete expired entries of a table, returns how many were deleted"""
+        raise NotImplementedError
+
+    def trim(self, table: str, max_size: int) -> int:
+        """Delete the entries expiring first until at most `max_size` are left"""
+        raise NotImplementedError
+
+    @contextmanager
+    def batch(self):
+        """Group writes so they are committed together, or not at all"""
+        yield self
+
+    def close(self):
+        pass
+
+    def table(self, name: str) -> "Table":
+        return Table(self, name)
+
+    def expiring_table(self, name: str, ttl: float, max_size: int) -> "ExpiringTable":
+        return ExpiringTable(self, name, ttl, max_size)
+
+
+class Table:
+    """Dict-like view over one table of a storage"""
+
+    def __init__(self, storage: Storage, name: str):
+        self.storage = storage
+        self.name = name
+
+    def get(self, key, default=None):
+        value = self.storage.get(self.name, str(key))
+        return default if value is None else value
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def set(self, key, value):
+        self.storage.put(self.name, str(key), value)
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def pop(self, key, default=None):
+        value = self.storage.pop(self.name, str(key))
+        return default if value is None else value
+
+    def items(self, after: str = None, limit: int = None):
+        return self.storage.items(self.name, after, limit)
+
+
+class ExpiringTable(Table):
+    """Table whose entries expire after `ttl` seconds, bounded to about `max_size` entries.
+
+    Expired entries read as missing right away and are deleted by `sweep`. Every
+    `max_size // 10` puts the table is trimmed back to `max_size`, dropping the entries
+    that would expire first, so memory stays flat however fast entries are added.
+    """
+
+    def __init__(self, storage: Storage, name: str, ttl: float, max_size: int):
+        super().__init__(storage, name)
+        self.ttl = ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+        self._puts = 0
+
+    def get(self, key, default=None):
+        value = self.storage.get(self.name, str(key))
+        if value is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        return value
+
+    def pop(self, key, default=None):
+        value = self.storage.pop(self.name, str(key))
+        if value is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        self.storage.put(self.name, str(key), value, self.ttl)
+        self._puts += 1
+        if self._puts >= max(1, self.max_size // 10):
+            self._puts = 0
+            self.evictions += self.storage.trim(self.name, self.max_size)
+
+    def sweep(self) -> int:
+        expired = self.storage.sweep(self.name)
+        self.expired += expired
+        self.evictions += self.storage.trim(self.name, self.max_size)
+        return expired
+
+    def stats(self) -> dict:
+        return {
+            "size": self.storage.count(self.name),
+            "hits": self.hits,
+            "misses": self.misses,
+            "expired": self.expired,
+            "evictions": self.evictions,
+        }
+
+
+class MemoryStorage(Storage):
+    """Process-local storage, nothing is persisted"""
+
+    def __init__(self):
+        self._tables = {}
+        self._lock = threading.RLock()
+        self._pending = None
+
+    def get(self, table, key):
+        with self._lock:
+            row = self._tables.get(table, {}).get(key)
+        if row is None or _expired(row[1], time.time()):
+            return None
+        # hand out copies so callers can't mutate stored state in place
+        return json.loads(row[0])
+
+    def put(self, table, key, value, ttl=None):
+        expires = None if ttl is None else time.time() + ttl
+        self._write(table, key, (json.dumps(value), expires))
+
+    def delete(self, table, key):
+        self._write(table, key, None)
+
+    def pop(self, table, key):
+        with self._lock:
+            row = self._tables.get(table, {}).get(key)
+            self._write(table, key, None)
+        if row is None or _expired(row[1], time.time()):
+            return None
+        return json.loads(row[0])
+
+    def items(self, table, after=None, limit=None):
+        now = time.time()
+        with self._lock:
+            rows = self._tables.get(table, {})
+            keys = sorted(
+                k
+                for k, row in rows.items()
+                if (after is None or k > after) and not _expired(row[1], now)
+            )[:limit]
+            rows = [(k, rows[k][0]) for k in keys]
+        for key, value in rows:
+            yield key, json.loads(value)
+
+    def count(self, table):
+        now = time.time()
+        with self._lock:
+            rows = self._tables.get(table, {})
+            return sum(1 for row in rows.values() if not _expired(row[1], now))
+
+    def sweep(self, table):
+        now = time.time()
+        with self._lock:
+            rows = self._tables.get(table, {})
+            expired = [k for k, row in rows.items() if _expired(row[1], now)]
+            for key in expired:
+                del rows[key]
+        return len(expired)
+
+    def trim(self, table, max_size):
+        with self._lock:
+            rows = self._tables.get(table, {})
+            if len(rows) <= max_size:
+                return 0
+            by_expiry = sorted(rows, key=lambda k: _expiry_order(rows[k][1]))
+            evicted = by_expiry[: len(rows) - max_size]
+            for key in evicted:
+                del rows[key]
+        return len(evicted)
+
+    def _write(self, table, key, value):
+        with self._lock:
+            if self._pending is not None:
+                self._pending.append((table, key, value))
+                return
+            self._apply([(table, key, value)])
+
+    def _apply(self, ops):
+        for table, key, value in ops:
+            rows = self._tables.setdefault(table, {})
+            if value is None:
+                rows.pop(key, None)
+            else:
+                rows[key] = value
+
+    @contextmanager
+    def batch(self):
+        with self._lock:
+            if self._pending is not None:
+                yield self
+                return
+            self._pending = []
+            try:
+                yield self
+                self._apply(self._pending)
+            finally:
+                self._pending = None
+
+
+class SqliteStorage(Storage):
+    """SQLite backed storage in WAL mode, safe to share between worker processes"""
+
+    # rows fetched per query when iterating a table
+    chunk_size = 500
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        with self._conn() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS kv ("
+                " tbl TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL,"
+                " PRIMARY KEY (tbl, key)) WITHOUT ROWID"
+            )
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(kv)")]
+            if "expires" not in columns:
+                conn.execute("ALTER TABLE kv ADD COLUMN expires REAL")
+            conn.execute("CREATE INDEX IF NOT EXISTS kv_expires ON kv (tbl, expires)")
+
+    def _conn(self) -> sqlite3.Connection:
+        # sqlite connections can't be shared between threads
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.depth = 0
+        return conn
+
+    def get(self, table, key):
+        row = (
+            self._conn()
+            .execute(
+                "SELECT value FROM kv WHERE tbl = ? AND key = ?"
+                " AND (expires IS NULL OR expires > ?)",
+                (table, key, time.time()),
+            )
+            .fetchone()
+        )
+        return None if row is None else json.loads(row[0])
+
+    def put(self, table, key, value, ttl=None):
+        expires = None if ttl is None else time.time() + ttl
+        with self.batch():
+            self._conn().execute(
+                "INSERT OR REPLACE INTO kv (tbl, key, value, expires)"
+                " VALUES (?, ?, ?, ?)",
+                (table, key, json.dumps(value), expires),
+            )
+
+    def delete(self, table, key):
+        with self.batch():
+            self._conn().execute(
+                "DELETE FROM kv WHERE tbl = ? AND key = ?", (table, key)
+            )
+
+    def pop(self, table, key):
+        # one statement, two workers popping the same key can't both get the value
+        with self.batch():
+            row = (
+                self._conn()
+                .execute(
+                    "DELETE FROM kv WHERE tbl = ? AND key = ? RETURNING value, expires",
+                    (table, key),
+                )
+                .fetchone()
+            )
+        if row is None or _expired(row[1], time.time()):
+            return None
+        return json.loads(row[0])
+
+    def items(self, table, after=None, limit=None):
+        # keyset pagination in chunks, memory stays flat however big the table is
+        while limit is None or limit > 0:
+            chunk = self.chunk_size if limit is None else min(limit, self.chunk_size)
+            rows = (
+                self._conn()
+                .execute(
+                    "SELECT key, value FROM kv WHERE tbl = ? AND key > ?"
+                    " AND (expires IS NULL OR expires > ?) ORDER BY key LIMIT ?",
+                    (table, "" if after is None else after, time.time(), chunk),
+                )
+                .fetchall()
+            )
+            for key, value in rows:
+                yield key, json.loads(value)
+            if len(rows) < chunk:
+                return
+            after = rows[-1][0]
+            if limit is not None:
+                limit -= len(rows)
+
+    def count(self, table):
+        return (
+            self._conn()
+            .execute(
+                "SELECT COUNT(*) FROM kv WHERE tbl = ?"
+                " AND (expires IS NULL OR expires > ?)",
+                (table, time.time()),
+            )
+            .fetchone()[0]
+        )
+
+    def sweep(self, table):
+        with self.batch():
+            return (
+                self._conn()
+                .execute(
+                    "DELETE FROM kv WHERE tbl = ? AND expires <= ?",
+                    (table, time.time()),
+                )
+                .rowcount
+            )
+
+    def trim(self, table, max_size):
+        # entries without ttl are kept, then the ones expiring last
+        with self.batch():
+            return (
+                self._conn()
+                .execute(
+                    "DELETE FROM kv WHERE tbl = ? AND key IN ("
+                    " SELECT key FROM kv WHERE tbl = ?"
+                    " ORDER BY expires IS NULL DESC, expires DESC"
+                    " LIMIT -1 OFFSET ?)",
+                    (table, table, max_size),
+                )
+                .rowcount
+            )
+
+    @contextmanager
+    def batch(self):
+        conn = self._conn()
+        if self._local.depth > 0:
+            self._local.depth += 1
+            try:
+                yield self
+            finally:
+                self._local.depth -= 1
+            return
+        self._local.depth = 1
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield self
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        else:
+            conn.execute("COMMIT")
+        finally:
+            self._local.depth = 0
+
+    def close(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+
+class CachedStorage(Storage):
+    """Read-through LRU cache in front of another storage.
+
+    Entries expire after `ttl` seconds so writes from other workers become visible.
+    Tables holding entries with their own ttl are not cached. Reads inside a batch go
+    to the backend, a read-modify-write must see what other workers committed.
+    """
+
+    _MISSING = object()
+
+    def __init__(self, backend: Storage, size: int = 10000, ttl: float = 5.0):
+        self.backend = backend
+        self.size = size
+        self.ttl = ttl
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._volatile = set()
+        # batches open in this thread
+        self._local = threading.local()
+
+    def expiring_table(self, name, ttl, max_size):
+        self._volatile.add(name)
+        return super().expiring_table(name, ttl, max_size)
+
+    def get(self, table, key):
+        if table in self._volatile:
+            return self.backend.get(table, key)
+        if getattr(self._local, "depth", 0) > 0:
+            value = self.backend.get(table, key)
+            self._remember(
+                table, key, self._MISSING if value is None else json.dumps(value)
+            )
+            return value
+        now = time.monotonic()
+        with self._lock:
+            entry = self._cache.get((table, key))
+            if entry is not None and entry[0] > now:
+                self._cache.move_to_end((table, key))
+                value = entry[1]
+                return None if value is self._MISSING else json.loads(value)
+        value = self.backend.get(table, key)
+        self._remember(table, key, self._MISSING if value is None else json.dumps(value))
+        return value
+
+    def put(self, table, key, value, ttl=None):
+        if ttl is not None:
+            self._volatile.add(table)
+        self.backend.put(table, key, value, ttl)
+        if table not in self._volatile:
+            self._remember(table, key, json.dumps(value))
+
+    def delete(self, table, key):
+        self.backend.delete(table, key)
+        self._remember(table, key, self._MISSING)
+
+    def pop(self, table, key):
+        value = self.backend.pop(table, key)
+        self._remember(table, key, self._MISSING)
+        return value
+
+    def items(self, table, after=None, limit=None):
+        return self.backend.items(table, after, limit)
+
+    def count(self, table):
+        return self.backend.count(table)
+
+    def sweep(self, table):
+        deleted = self.backend.sweep(table)
+        if deleted:
+            self._forget(table)
+        return deleted
+
+    def trim(self, table, max_size):
+        deleted = self.backend.trim(table, max_size)
+        if deleted:
+            self._forget(table)
+        return deleted
+
+    @contextmanager
+    def batch(self):
+        self._local.depth = getattr(self._local, "depth", 0) + 1
+        try:
+            with self.backend.batch():
+                yield self
+        except BaseException:
+            # writes of a failed batch may already be cached, drop them all
+            with self._lock:
+                self._cache.clear()
+            raise
+        finally:
+            self._local.depth -= 1
+
+    def close(self):
+        self.backend.close()
+
+    def _remember(self, table, key, value):
+        with self._lock:
+            self._cache[(table, key)] = (time.monotonic() + self.ttl, value)
+            self._cache.move_to_end((table, key))
+            while len(self._cache) > self.size:
+                self._cache.popitem(last=False)
+
+    def _forget(self, table):
+        with self._lock:
+            for cached in [k for k in self._cache if k[0] == table]:
+                del self._cache[cached]
+
+
+def _expired(expires: float | None, now: float) -> bool:
+    return expires is not None and expires <= now
+
+
+def _expiry_order(expires: float | None) -> float:
+    # entries without ttl go last, like NULLs in the SQLite ordering
+    return float("inf") if expires is None else expires
+
+
+def open_storage(url: str) -> Storage:
+    """`:memory:` for a process-local store, otherwise path of a SQLite file"""
+    if url == ":memory:":
+        return MemoryStorage()
+    return CachedStorage(SqliteStorage(url))
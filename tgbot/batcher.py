@@ -0,0 +1,64 @@
+"""Coalesces bursts of join requests into one check per group.
+
+Join requests are buffered per group for `JOIN_WINDOW` seconds, or until
+`JOIN_BATCH_MAX` are waiting, then handed to `check` together, so a launch with
+hundreds of requests costs one share check per group per window.
+"""
+
+import asyncio
+import logging
+import os
+
+from telegram import ChatJoinRequest
+
+# seconds join requests to a group are buffered before being checked together
+JOIN_WINDOW = float(os.environ.get("JOIN_WINDOW", "1"))
+# requests that close a window early
+JOIN_BATCH_MAX = int(os.environ.get("JOIN_BATCH_MAX", "200"))
+
+logger = logging.getLogger(__name__)
+
+
+class JoinRequestBatcher:
+    def __init__(self, check, window: float = JOIN_WINDOW, max_batch=JOIN_BATCH_MAX):
+        """`await check(chat_id, requests)` handles the requests of a window"""
+        self.check = check
+        self.window = window
+        self.max_batch = max_batch
+        self._pending: dict[int, dict[int, ChatJoinRequest]] = {}
+        self._tasks = set()
+
+    def add(self, request: ChatJoinRequest):
+        chat_id = request.chat.id
+        pending = self._pending.get(chat_id)
+        if pending is None:
+            pending = self._pending[chat_id] = {}
+            self._spawn(self._flush_later(chat_id, pending))
+        # a user asking again within the window is checked once
+        pending[request.from_user.id] = request
+        if len(pending) >= self.max_batch:
+            del self._pending[chat_id]
+            self._spawn(self._flush(chat_id, pending))
+
+    def stop(self):
+        for task in self._tasks:
+            task.cancel()
+
+    def _spawn(self, coroutine):
+        task = asyncio.create_task(coroutine)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _flush_later(self, chat_id: int, pending: dict):
+        await asyncio.sleep(self.window)
+        # already flushed if the batch filled up
+        if self._pending.get(chat_id) is pending:
+            del self._pending[chat_id]
+            await self._flush(chat_id, pending)
+
+    async def _flush(self, chat_id: int, pending: dict):
+        try:
+            await self.check(chat_id, list(pending.values()))
+        except Exception:
+            # unanswered requests stay pending on Telegram, the user can ask again
+            logger.exception("failed to check %d join requests", len(pending))
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+"""
+Benchmark `call_many` against one `call` per group at growing group counts.
+
+Reads `sharesBalance(holder, subject)` for 10, 100 and 1000 made up groups through the
+node in `ETH_RPC`, e.g. a local `fake_rpc.py` in front of a dev chain or a real node:
+```
+python3 ./fake_rpc.py --upstream https://mainnet.base.org --port 8545 --latency 0.05
+ETH_RPC=http://127.0.0.1:8545 python3 ./bench_call_many.py --groups 10 100 1000
+```
+Every read is at a pinned block, so both modes fetch the same state and the block
+cache is not involved.
+"""
+
+import argparse
+import asyncio
+import time
+
+from web3 import Web3
+
+import chain
+
+
+def percentile(samples: list[float], p: float) -> float:
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * p))] * 1000
+
+
+async def measure(run, rounds: int) -> list[float]:
+    samples = []
+    for _ in range(rounds):
+        started = time.monotonic()
+        await run()
+        samples.append(time.monotonic() - started)
+    return samples
+
+
+async def bench(groups: list[int], rounds: int, holder: str):
+    await chain.open_session()
+    try:
+        block = await chain.w3.eth.block_number
+        for n in groups:
+            functions = [
+                chain.contract.functions.sharesBalance(
+                    Web3.to_checksum_address(f"0x{i + 1:040x}"), holder
+                )
+                for i in range(n)
+            ]
+            batched = await measure(
+                lambda: chain.call_many(functions, block), rounds
+            )
+            single = await measure(
+                lambda: asyncio.gather(
+                    *(chain.call(function, block) for function in functions)
+                ),
+                rounds,
+            )
+            for name, samples in (("call_many", batched), ("call", single)):
+                print(
+                    f"{n} groups, {name}: p50 {percentile(samples, 0.5):.1f}ms"
+                    f" p99 {percentile(samples, 0.99):.1f}ms"
+                )
+        print(f"rpc: {chain.w3.provider.stats()}")
+    finally:
+        await chain.close_session()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--groups", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--rounds", type=int, default=10)
+    parser.add_argument(
+        "--holder", default="0x0000000000000000000000000000000000000001"
+    )
+    args = parser.parse_args()
+    asyncio.run(
+        bench(args.groups, args.rounds, Web3.to_checksum_address(args.holder))
+    )
+
+
+if __name__ == "__main__":
+    main()
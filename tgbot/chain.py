@@ -0,0 +1,321 @@
+"""Async access to the Fans3 contract.
+
+Every RPC goes through `call`, which bounds it with a timeout, retries network
+failures with exponential backoff and caps the RPCs in flight. All requests share one
+pooled aiohttp session. `ETH_RPC` may list several endpoints, requests are routed to
+the healthiest one and hedged when it's slow.
+`call_many` packs many reads into Multicall3 `aggregate3` calls, one round-trip each.
+
+On-chain share state only changes once per block, `cached_call` and `cached_call_many`
+serve reads from a cache keyed by (function, args) at the current block, so a burst of
+updates within one block costs one RPC per distinct read.
+"""
+
+import asyncio
+import functools
+import json
+import logging
+import os
+from collections import OrderedDict
+
+import aiohttp
+from dotenv import load_dotenv
+from eth_utils import collapse_if_tuple, function_abi_to_4byte_selector
+from web3 import AsyncWeb3, Web3
+
+from rpc_router import BlockUnavailable, RouterProvider
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+load_dotenv(os.path.join(BASE_DIR, ".env"))
+
+# seconds before a single RPC is abandoned
+RPC_TIMEOUT = float(os.environ.get("RPC_TIMEOUT", "10"))
+# retries of an RPC failing with a network error, a timeout or a block not synced yet
+RPC_RETRIES = int(os.environ.get("RPC_RETRIES", "3"))
+# first backoff in seconds, doubled on every retry
+RPC_BACKOFF = float(os.environ.get("RPC_BACKOFF", "0.5"))
+# max open connections to the RPC node
+RPC_POOL_SIZE = int(os.environ.get("RPC_POOL_SIZE", "32"))
+# weight of the newest sample in the latency and error rate averages of an endpoint
+RPC_EWMA_ALPHA = float(os.environ.get("RPC_EWMA_ALPHA", "0.2"))
+# seconds for the error rate of an endpoint to halve
+RPC_ERROR_HALFLIFE = float(os.environ.get("RPC_ERROR_HALFLIFE", "60"))
+# min seconds before a read is hedged to the next endpoint
+RPC_HEDGE_MIN = float(os.environ.get("RPC_HEDGE_MIN", "0.05"))
+# max RPCs in flight, handlers past it wait instead of piling onto a slow node
+RPC_CONCURRENCY = int(os.environ.get("RPC_CONCURRENCY", str(RPC_POOL_SIZE)))
+# Multicall3 is deployed at the same address on most chains, empty to disable
+MULTICALL_ADDRESS = os.environ.get(
+    "MULTICALL_ADDRESS", "0xcA11bde05977b3631167028862bE2a173976CA11"
+)
+# seconds between polls of the latest block number
+BLOCK_POLL_INTERVAL = float(os.environ.get("BLOCK_POLL_INTERVAL", "2"))
+# max reads kept in the block cache
+BLOCK_CACHE_SIZE = int(os.environ.get("BLOCK_CACHE_SIZE", "10000"))
+# max calls packed into one multicall
+MULTICALL_BATCH = int(os.environ.get("MULTICALL_BATCH", "500"))
+MULTICALL_ABI = [
+    {
+        "inputs": [
+            {
+                "components": [
+                    {"internalType": "address", "name": "target", "type": "address"},
+                    {"internalType": "bool", "name": "allowFailure", "type": "bool"},
+                    {"internalType": "bytes", "name": "callData", "type": "bytes"},
+                ],
+                "internalType": "struct Multicall3.Call3[]",
+                "name": "calls",
+                "type": "tuple[]",
+            }
+        ],
+        "name": "aggregate3",
+        "outputs": [
+            {
+                "components": [
+                    {"internalType": "bool", "name": "success", "type": "bool"},
+                    {"internalType": "bytes", "name": "returnData", "type": "bytes"},
+                ],
+                "internalType": "struct Multicall3.Result[]",
+                "name": "returnData",
+                "type": "tuple[]",
+            }
+        ],
+        "stateMutability": "payable",
+        "type": "function",
+    }
+]
+
+logger = logging.getLogger(__name__)
+
+ABI = json.load(open(os.path.join(BASE_DIR, "fans3.json")))
+w3 = AsyncWeb3(
+    RouterProvider(
+        [url.strip() for url in os.environ["ETH_RPC"].split(",") if url.strip()],
+        alpha=RPC_EWMA_ALPHA,
+        error_halflife=RPC_ERROR_HALFLIFE,
+        hedge_min=RPC_HEDGE_MIN,
+    )
+)
+contract = w3.eth.contract(
+    address=Web3.to_checksum_address(os.environ["CONTRACT_ADDRESS"]), abi=ABI
+)
+
+multicall = (
+    w3.eth.contract(
+        address=Web3.to_checksum_address(MULTICALL_ADDRESS), abi=MULTICALL_ABI
+    )
+    if MULTICALL_ADDRESS
+    else None
+)
+
+_session: aiohttp.ClientSession | None = None
+_block_watcher: asyncio.Task | None = None
+_rpc_slots = asyncio.Semaphore(RPC_CONCURRENCY)
+_rpc_in_flight = 0
+_rpc_waiting = 0
+
+
+def rpc_stats() -> dict:
+    """RPCs in flight and RPCs waiting for a slot"""
+    return {"rpc_in_flight": _rpc_in_flight, "rpc_waiting": _rpc_waiting}
+
+
+async def open_session():
+    """Create the pooled HTTP session used by every RPC, call once on startup"""
+    global _session
+    _session = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=RPC_POOL_SIZE),
+        timeout=aiohttp.ClientTimeout(total=RPC_TIMEOUT),
+    )
+    await w3.provider.cache_async_session(_session)
+
+
+async def close_session():
+    if _block_watcher is not None:
+        _block_watcher.cancel()
+    if _session is not None:
+        await _session.close()
+
+
+async def call(function, block_identifier="latest"):
+    """Call a contract view function, e.g. `call(contract.functions.sharesSupply(a))`"""
+    global _rpc_in_flight, _rpc_waiting
+    for attempt in range(RPC_RETRIES + 1):
+        _rpc_waiting += 1
+        try:
+            await _rpc_slots.acquire()
+        finally:
+            _rpc_waiting -= 1
+        _rpc_in_flight += 1
+        try:
+            return await asyncio.wait_for(
+                function.call(block_identifier=block_identifier), RPC_TIMEOUT
+            )
+        except (asyncio.TimeoutError, aiohttp.ClientError, BlockUnavailable) as e:
+            # every endpoint still behind a pinned block catches up in a moment
+            if attempt == RPC_RETRIES:
+                raise
+            delay = RPC_BACKOFF * 2**attempt
+            logger.warning(
+                "rpc %s failed (%r), retry in %.1fs", function.fn_name, e, delay
+            )
+        finally:
+            _rpc_in_flight -= 1
+            _rpc_slots.release()
+        # back off without holding a slot
+        await asyncio.sleep(delay)
+
+
+def _encode(function) -> bytes:
+    types = [collapse_if_tuple(i) for i in function.abi["inputs"]]
+    return function_abi_to_4byte_selector(function.abi) + w3.codec.encode(
+        types, function.args
+    )
+
+
+def _decode(function, data: bytes):
+    types = [collapse_if_tuple(o) for o in function.abi["outputs"]]
+    values = w3.codec.decode(types, data)
+    return values[0] if len(values) == 1 else values
+
+
+async def _call_batch(functions: list, block_identifier) -> list:
+    calls = [(function.address, True, _encode(function)) for function in functions]
+    results = await call(multicall.functions.aggregate3(calls), block_identifier)
+    return [
+        _decode(function, data) if success else None
+        for function, (success, data) in zip(functions, results)
+    ]
+
+
+async def call_many(functions: list, block_identifier="latest") -> list:
+    """Call many view functions in as few round-trips as possible.
+
+    Results come back in order, None for a call that reverted.
+    """
+    if len(functions) == 0:
+        return []
+    if multicall is None:
+        return await asyncio.gather(
+            *(call(function, block_identifier) for function in functions)
+        )
+    batches = await asyncio.gather(
+        *(
+            _call_batch(functions[i : i + MULTICALL_BATCH], block_identifier)
+            for i in range(0, len(functions), MULTICALL_BATCH)
+        )
+    )
+    return [result for batch in batches for result in batch]
+
+
+class BlockCache:
+    """Results of view calls at the current block, dropped when a new block arrives.
+
+    Entries are futures, so concurrent reads of the same key share one RPC. The RPC runs
+    in its own task, a reader that gets cancelled doesn't cancel it for the others.
+    """
+
+    def __init__(self, size: int = BLOCK_CACHE_SIZE):
+        self.size = size
+        self.block = None
+        self._entries = OrderedDict()
+        self._fetches = set()
+
+    def set_block(self, block: int):
+        if self.block is None or block > self.block:
+            self.block = block
+            self._entries.clear()
+
+    async def call(self, function):
+        if self.block is None:
+            return await call(function)
+        block = self.block
+        return (
+            await self._resolve(
+                [function],
+                lambda functions: asyncio.gather(call(functions[0], block)),
+            )
+        )[0]
+
+    async def call_many(self, functions: list) -> list:
+        if self.block is None:
+            return await call_many(functions)
+        block = self.block
+        return await self._resolve(
+            functions, lambda functions: call_many(functions, block)
+        )
+
+    async def _resolve(self, functions: list, fetch) -> list:
+        loop = asyncio.get_running_loop()
+        futures = []
+        missing = []
+        for function in functions:
+            key = (function.fn_name, tuple(function.args))
+            future = self._entries.get(key)
+            if future is None:
+                future = loop.create_future()
+                self._entries[key] = future
+                missing.append((key, function, future))
+                if len(self._entries) > self.size:
+                    self._entries.popitem(last=False)
+            else:
+                self._entries.move_to_end(key)
+            futures.append(future)
+        if len(missing) != 0:
+            task = asyncio.create_task(
+                self._fetch(fetch, [function for _, function, _ in missing])
+            )
+            self._fetches.add(task)
+            task.add_done_callback(functools.partial(self._settle, missing))
+        return [await asyncio.shield(future) for future in futures]
+
+    @staticmethod
+    async def _fetch(fetch, functions: list) -> list:
+        return await fetch(functions)
+
+    def _settle(self, missing: list, task: asyncio.Task):
+        self._fetches.discard(task)
+        if task.cancelled() or task.exception() is not None:
+            # failures are not cached, the next read tries again
+            for key, _, future in missing:
+                if self._entries.get(key) is future:
+                    del self._entries[key]
+                if task.cancelled():
+                    # only on shutdown, nobody else cancels a fetch
+                    future.cancel()
+                else:
+                    future.set_exception(task.exception())
+                    future.exception()
+            return
+        for (_, _, future), result in zip(missing, task.result()):
+            future.set_result(result)
+
+
+block_cache = BlockCache()
+
+
+async def _watch_blocks():
+    while True:
+        try:
+            block_cache.set_block(
+                await asyncio.wait_for(w3.eth.block_number, RPC_TIMEOUT)
+            )
+        except Exception as e:
+            logger.warning("failed to poll block number: %r", e)
+        await asyncio.sleep(BLOCK_POLL_INTERVAL)
+
+
+def start_block_watcher():
+    """Follow new blocks to invalidate the block cache, call once on startup"""
+    global _block_watcher
+    _block_watcher = asyncio.create_task(_watch_blocks())
+
+
+async def cached_call(function):
+    """`call` at the current block, served from the block cache when possible"""
+    return await block_cache.call(function)
+
+
+async def cached_call_many(functions: list) -> list:
+    """`call_many` at the current block, only reads missing from the cache go out"""
+    return await block_cache.call_many(functions)
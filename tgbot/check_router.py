@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+"""
+Drive the RPC router against two local stub endpoints and check how it routes.
+
+Runs two `fake_rpc.py` stubs in process and changes their latency, errors and lag
+between phases, no node or network needed:
+```
+python3 ./check_router.py
+```
+Phases check hedging past a stalled endpoint, failover on unknown-block errors and on
+HTTP failures, and that the latency and error averages move traffic to the healthy
+endpoint. Exits with status 1 if a check fails.
+"""
+
+import argparse
+import asyncio
+import sys
+import time
+
+import aiohttp
+from aiohttp import web
+
+from fake_rpc import create_app
+from rpc_router import RouterProvider
+
+# far apart blocks, the stub heads only differ by their lag
+BLOCK_TIME = 3600
+CALL = {"to": "0x" + "00" * 20, "data": "0x"}
+
+
+async def serve(port: int, latency: float) -> tuple[web.Application, web.AppRunner]:
+    app = create_app(None, latency, 0, 0, BLOCK_TIME)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+    return app, runner
+
+
+async def send(router: RouterProvider, n: int, block="latest") -> tuple[list, int]:
+    """Latencies of n sequential eth_calls and how many of them failed"""
+    latencies = []
+    failed = 0
+    for _ in range(n):
+        started = time.monotonic()
+        try:
+            response = await router.make_request("eth_call", [CALL, block])
+            failed += "result" not in response
+        except Exception:
+            failed += 1
+        latencies.append(time.monotonic() - started)
+    return latencies, failed
+
+
+def first(router: RouterProvider):
+    return min(router.endpoints, key=lambda e: e.score(router.error_penalty))
+
+
+async def check(ports: list[int], n: int) -> bool:
+    (a, runner_a), (b, runner_b) = [
+        await serve(port, latency) for port, latency in zip(ports, (0.01, 0.03))
+    ]
+    router = RouterProvider(
+        [f"http://127.0.0.1:{port}" for port in ports], hedge_min=0.05
+    )
+    session = aiohttp.ClientSession()
+    await router.cache_async_session(session)
+    endpoint_a, endpoint_b = router.endpoints
+    results = []
+
+    def expect(name: str, ok: bool):
+        results.append(ok)
+        print(f"{'ok  ' if ok else 'FAIL'} {name}")
+
+    try:
+        _, failed = await send(router, n)
+        expect("healthy: every read answered", failed == 0)
+        expect("healthy: the faster endpoint ranks first", first(router) is endpoint_a)
+
+        # the first choice stalls, the hedge to the other endpoint answers
+        a["settings"]["latency"] = 1.0
+        latencies, failed = await send(router, n)
+        expect("stalled: every read answered", failed == 0)
+        expect(
+            "stalled: hedged reads stay well under the stall",
+            max(latencies) < 0.5,
+        )
+        expect("stalled: lost hedges move traffic away", first(router) is endpoint_b)
+        a["settings"]["latency"] = 0.01
+
+        # reads pinned to a block the first choice doesn't have yet fail over
+        b["settings"]["lag"] = 1
+        head = await endpoint_a.provider.make_request("eth_blockNumber", [])
+        _, failed = await send(router, n, head["result"])
+        expect("lagging: every pinned read answered", failed == 0)
+        expect("lagging: unknown block counts as an error", endpoint_b.error_rate > 0)
+        b["settings"]["lag"] = 0
+
+        # HTTP failures fail over and the error average moves traffic away
+        a["settings"]["error_rate"] = 1.0
+        _, failed = await send(router, n)
+        expect("failing: every read answered", failed == 0)
+        expect(
+            "failing: errors move traffic away",
+            endpoint_a.error_rate > endpoint_b.error_rate
+            and first(router) is endpoint_b,
+        )
+    finally:
+        await session.close()
+        await runner_a.cleanup()
+        await runner_b.cleanup()
+    for endpoint, app in ((endpoint_a, a), (endpoint_b, b)):
+        print(f"{endpoint.name}: {dict(app['counts'])}")
+    print(f"router: {router.stats()}")
+    return all(results)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--ports", type=int, nargs=2, default=[18545, 18546])
+    parser.add_argument("--requests", type=int, default=20, help="reads per phase")
+    args = parser.parse_args()
+    if not asyncio.run(check(args.ports, args.requests)):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
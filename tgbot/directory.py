@@ -0,0 +1,117 @@
+"""Materialized "Known groups" directory shown by /start.
+
+Each registered group has a pre-rendered line under `dir_line_<chat_id>`, refreshed
+only when the group is registered or its share price changes. Lines are cut into pages
+that fit a Telegram message, so listing groups costs the same however many there are.
+"""
+
+import logging
+
+from web3 import Web3
+
+from pricing import PriceEngine
+from store import PREFIX_CHAT_RECORD, BotStore
+
+PREFIX_DIRECTORY_LINE = "dir_line_"
+KEY_MIGRATION_DIRECTORY = "migration_dir_line"
+# max characters of a page, leaves room for the rest of the /start message
+PAGE_CHARS = 2500
+
+logger = logging.getLogger(__name__)
+
+
+class GroupDirectory:
+    def __init__(self, store: BotStore, base_url: str, prices: PriceEngine):
+        self.store = store
+        self.base_url = base_url
+        self.prices = prices
+        self._lines = {}
+        self._pages = []
+        self._dirty = False
+
+    def load(self):
+        """Load rendered lines, call once on startup"""
+        for k, line in self.store.range(PREFIX_DIRECTORY_LINE):
+            self._lines[k[len(PREFIX_DIRECTORY_LINE) :]] = line
+        self._dirty = True
+
+    @property
+    def built(self) -> bool:
+        return self.store.get(KEY_MIGRATION_DIRECTORY) is not None
+
+    async def rebuild(self):
+        """Render every registered group again, one price read for all of them"""
+        chat_ids = [
+            k[len(PREFIX_CHAT_RECORD) :]
+            for k, _ in self.store.range(PREFIX_CHAT_RECORD)
+        ]
+        await self.refresh(chat_ids)
+        with self.store.batch() as batch:
+            # groups dropped by `repair` leave their line behind
+            for chat_id in set(self._lines) - set(chat_ids):
+                batch.delete(f"{PREFIX_DIRECTORY_LINE}{chat_id}")
+                del self._lines[chat_id]
+                self._dirty = True
+            batch.put(KEY_MIGRATION_DIRECTORY, len(chat_ids))
+
+    async def refresh_subjects(self, subjects: set[str]):
+        """Render the groups of subjects whose price changed"""
+        await self.refresh(
+            [
+                chat_id
+                for subject in subjects
+                for chat_id in self.store.chat_ids_of_address(subject)
+            ]
+        )
+
+    async def refresh(self, chat_ids: list):
+        """Render lines of groups, pricing all of them from one supply snapshot"""
+        chat_ids = [str(chat_id) for chat_id in dict.fromkeys(chat_ids)]
+        records = self.store.chat_records(chat_ids)
+        listed = [
+            (chat_id, record)
+            for chat_id, record in zip(chat_ids, records)
+            if record is not None
+        ]
+        prices = await self.prices.buy_prices(
+            [Web3.to_checksum_address(record.address) for _, record in listed]
+        )
+        with self.store.batch() as batch:
+            for (chat_id, record), price in zip(listed, prices):
+                if price is None:
+                    continue
+                line = self.render(record.title, record.address, price)
+                if self._lines.get(chat_id) == line:
+                    continue
+                batch.put(f"{PREFIX_DIRECTORY_LINE}{chat_id}", line)
+                self._lines[chat_id] = line
+                self._dirty = True
+
+    def render(self, title: str, address: str, price: int) -> str:
+        priceEth = Web3.from_wei(price, "ether")
+        return (
+            f"[{title}]({self.base_url}/tg/buy/{address})"
+            f" (`{priceEth} ETH` `{address}`)\n"
+        )
+
+    def page(self, index: int) -> tuple[str, int, int]:
+        """Text of a page, its index clamped to the pages there are, and the page count"""
+        if self._dirty:
+            self._paginate()
+        if len(self._pages) == 0:
+            return "", 0, 0
+        index = min(max(index, 0), len(self._pages) - 1)
+        return self._pages[index], index, len(self._pages)
+
+    def _paginate(self):
+        pages = []
+        page = ""
+        for line in self._lines.values():
+            if len(page) != 0 and len(page) + len(line) > PAGE_CHARS:
+                pages.append(page)
+                page = ""
+            page += line
+        if len(page) != 0:
+            pages.append(page)
+        self._pages = pages
+        self._dirty = False
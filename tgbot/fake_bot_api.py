@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+"""
+Local stand-in for the Telegram Bot API, to replay updates without a network.
+
+Every method succeeds after `--latency` seconds with a made up but well formed result:
+messages echo their chat, members are admins, invite links are fresh. Point the bot at
+it with `TELEGRAM_API_URL`, then replay recorded updates:
+```
+python3 ./fake_bot_api.py --port 8081 --latency 0.05
+TELEGRAM_API_URL=http://127.0.0.1:8081 WEBHOOK_URL=http://127.0.0.1:8443 \
+    WEBHOOK_SECRET=xxx python3 ./tg_bot.py
+python3 ./replay_updates.py updates.jsonl --secret xxx
+```
+`GET /stats` returns the calls per method.
+"""
+
+import argparse
+import asyncio
+import itertools
+import time
+from collections import Counter
+
+from aiohttp import web
+
+BOT_USER = {
+    "id": 1,
+    "is_bot": True,
+    "first_name": "Fake",
+    "username": "fake_bot",
+    "can_join_groups": True,
+    "can_read_all_group_messages": False,
+    "supports_inline_queries": False,
+}
+
+
+def _chat(chat_id: int) -> dict:
+    if chat_id > 0:
+        return {"id": chat_id, "type": "private", "first_name": f"user{chat_id}"}
+    return {"id": chat_id, "type": "supergroup", "title": f"group{-chat_id}"}
+
+
+def _int(params: dict, name: str, default: int = 0) -> int:
+    try:
+        return int(params.get(name, default))
+    except (TypeError, ValueError):
+        return default
+
+
+def create_app(latency: float) -> web.Application:
+    calls = Counter()
+    message_ids = itertools.count(1)
+    link_ids = itertools.count(1)
+
+    def message(params: dict) -> dict | bool:
+        if "chat_id" not in params:
+            # inline messages are edited without a result
+            return True
+        return {
+            "message_id": _int(params, "message_id") or next(message_ids),
+            "date": int(time.time()),
+            "chat": _chat(_int(params, "chat_id")),
+            "from": BOT_USER,
+            "text": params.get("text", ""),
+        }
+
+    def chat_member(params: dict) -> dict:
+        user_id = _int(params, "user_id")
+        user = BOT_USER if user_id == BOT_USER["id"] else {
+            "id": user_id,
+            "is_bot": False,
+            "first_name": f"user{user_id}",
+        }
+        rights = (
+            "can_manage_chat can_delete_messages can_manage_video_chats"
+            " can_restrict_members can_promote_members can_change_info"
+            " can_invite_users can_post_stories can_edit_stories"
+            " can_delete_stories"
+        ).split()
+        return {
+            "status": "administrator",
+            "user": user,
+            "can_be_edited": False,
+            "is_anonymous": False,
+            **{right: True for right in rights},
+        }
+
+    def invite_link(params: dict, revoked: bool = False) -> dict:
+        return {
+            "invite_link": params.get("invite_link")
+            or f"https://t.me/+fake{next(link_ids)}",
+            "creator": BOT_USER,
+            "creates_join_request": params.get("creates_join_request")
+            in (True, "true"),
+            "is_primary": False,
+            "is_revoked": revoked,
+            "name": params.get("name"),
+            "expire_date": _int(params, "expire_date") or None,
+        }
+
+    results = {
+        "getMe": lambda params: BOT_USER,
+        "sendMessage": message,
+        "editMessageText": message,
+        "editMessageReplyMarkup": message,
+        "getChat": lambda params: {
+            **_chat(_int(params, "chat_id")),
+            "permissions": {"can_send_messages": True, "can_invite_users": False},
+        },
+        "getChatMember": chat_member,
+        "createChatInviteLink": invite_link,
+        "revokeChatInviteLink": lambda params: invite_link(params, revoked=True),
+    }
+
+    async def method(request: web.Request) -> web.Response:
+        name = request.match_info["method"]
+        calls[name] += 1
+        if request.content_type == "application/json":
+            params = await request.json()
+        else:
+            # form fields, anything but a string arrives JSON encoded
+            params = dict(await request.post())
+        await asyncio.sleep(latency)
+        result = results.get(name, lambda params: True)(params)
+        return web.json_response({"ok": True, "result": result})
+
+    async def stats(request: web.Request) -> web.Response:
+        return web.json_response(dict(calls))
+
+    app = web.Application()
+    app.router.add_post("/bot{token}/{method}", method)
+    app.router.add_get("/stats", stats)
+    return app
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency", type=float, default=0, help="seconds per call")
+    args = parser.parse_args()
+    web.run_app(create_app(args.latency), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
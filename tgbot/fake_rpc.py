@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+"""
+Local JSON-RPC endpoint with injected latency and failures, to exercise the RPC router.
+
+With `--upstream` it proxies a real node. Start a fast and a slow, flaky endpoint in
+front of one, then point the bot at both:
+```
+python3 ./fake_rpc.py --upstream https://mainnet.base.org --port 8545 --latency 0.02
+python3 ./fake_rpc.py --upstream https://mainnet.base.org --port 8546 --latency 0.3 \
+    --jitter 1 --error-rate 0.2
+ETH_RPC=http://127.0.0.1:8545,http://127.0.0.1:8546 python3 ./tg_bot.py
+```
+Without it, it's a self-contained stub. Its chain makes a block every `--block-time`
+seconds and it reports `--lag` blocks less. `eth_call` returns a zero word, or "header
+not found" for a block past its head. `check_router.py` runs the router against two
+stubs.
+"""
+
+import argparse
+import asyncio
+import random
+import time
+from collections import Counter
+
+import aiohttp
+from aiohttp import web
+
+
+# head of every stub chain, they all start at the same block
+STUB_GENESIS = 1_000_000
+
+
+def _stub_answer(body: dict, head: int) -> dict:
+    method, params = body.get("method"), body.get("params") or []
+    answer = {"jsonrpc": "2.0", "id": body.get("id")}
+    if method == "eth_blockNumber":
+        return {**answer, "result": hex(head)}
+    if method == "eth_chainId":
+        return {**answer, "result": hex(8453)}
+    if method == "eth_call":
+        block = params[1] if len(params) > 1 else "latest"
+        if isinstance(block, str) and block.startswith("0x") and int(block, 16) > head:
+            return {**answer, "error": {"code": -32000, "message": "header not found"}}
+        return {**answer, "result": "0x" + "00" * 32}
+    return {**answer, "error": {"code": -32601, "message": f"{method} not supported"}}
+
+
+def create_app(
+    upstream: str | None,
+    latency: float,
+    jitter: float,
+    error_rate: float,
+    block_time: float = 2,
+    lag: int = 0,
+) -> web.Application:
+    started = time.monotonic()
+    # read on every request, a test can change them while the app runs
+    settings = {
+        "latency": latency,
+        "jitter": jitter,
+        "error_rate": error_rate,
+        "lag": lag,
+    }
+    counts = Counter()
+
+    async def on_startup(app: web.Application):
+        app["session"] = aiohttp.ClientSession()
+
+    async def on_cleanup(app: web.Application):
+        await app["session"].close()
+
+    async def proxy(request: web.Request) -> web.Response:
+        counts["requests"] += 1
+        # exponential tail, most requests take about `latency`, a few much longer
+        jitter = settings["jitter"]
+        extra = random.expovariate(1 / jitter) if jitter else 0
+        await asyncio.sleep(settings["latency"] + extra)
+        if random.random() < settings["error_rate"]:
+            counts["failures"] += 1
+            return web.Response(status=502, text="injected failure")
+        if upstream is None:
+            head = (
+                STUB_GENESIS
+                + int((time.monotonic() - started) / block_time)
+                - settings["lag"]
+            )
+            return web.json_response(_stub_answer(await request.json(), head))
+        async with request.app["session"].post(
+            upstream,
+            data=await request.read(),
+            headers={"Content-Type": "application/json"},
+        ) as resp:
+            return web.Response(
+                status=resp.status,
+                body=await resp.read(),
+                content_type="application/json",
+            )
+
+    app = web.Application()
+    app["settings"] = settings
+    app["counts"] = counts
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    app.router.add_post("/", proxy)
+    return app
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--upstream", help="real JSON-RPC endpoint, a stub if unset")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8545)
+    parser.add_argument("--latency", type=float, default=0, help="seconds added")
+    parser.add_argument("--jitter", type=float, default=0, help="mean extra seconds")
+    parser.add_argument("--error-rate", type=float, default=0, help="share of 502s")
+    parser.add_argument("--block-time", type=float, default=2, help="stub seconds")
+    parser.add_argument("--lag", type=int, default=0, help="stub blocks behind")
+    args = parser.parse_args()
+    web.run_app(
+        create_app(
+            args.upstream,
+            args.latency,
+            args.jitter,
+            args.error_rate,
+            args.block_time,
+            args.lag,
+        ),
+        host=args.host,
+        port=args.port,
+    )
+
+
+if __name__ == "__main__":
+    main()
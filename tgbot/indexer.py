@@ -0,0 +1,200 @@
+"""Index Fans3 `Trade` events into a local mirror of holdings and supply.
+
+Logs are pulled in block-range batches up to `INDEX_CONFIRMATIONS` blocks behind the
+head, and each batch is committed with its checkpoint in one RocksDB write batch, so a
+restart resumes exactly where it stopped. Once caught up with the chain, listeners are
+called with the trades of every committed range. Every write keeps the previous value in an
+undo journal for `INDEX_REORG_WINDOW` blocks; when the checkpoint block is no longer
+canonical the journal is replayed backwards and the range indexed again.
+
+Keys:
+    hold_<holder>_<subject> -> shares of subject held by holder
+    supply_<subject>        -> shares supply of subject
+"""
+
+import asyncio
+import logging
+import os
+
+from eth_utils import event_abi_to_log_topic
+from rocksdict import Rdict, WriteBatch
+
+import chain
+
+# first block to index, usually the contract deployment block, unset disables indexing
+INDEX_FROM_BLOCK = os.environ.get("INDEX_FROM_BLOCK")
+# blocks fetched per get_logs request
+INDEX_BATCH_BLOCKS = int(os.environ.get("INDEX_BATCH_BLOCKS", "2000"))
+# blocks behind the head considered final enough to index
+INDEX_CONFIRMATIONS = int(os.environ.get("INDEX_CONFIRMATIONS", "12"))
+# blocks of undo journal kept to survive deeper reorgs
+INDEX_REORG_WINDOW = int(os.environ.get("INDEX_REORG_WINDOW", "256"))
+
+PREFIX_HOLDING = "hold_"
+PREFIX_SUPPLY = "supply_"
+PREFIX_UNDO = "index_undo_"
+KEY_CHECKPOINT = "index_checkpoint"
+
+logger = logging.getLogger(__name__)
+
+
+def _undo_key(block: int, log_index: int) -> str:
+    return f"{PREFIX_UNDO}{block:012d}_{log_index:06d}"
+
+
+def _undo_block(key: str) -> int:
+    return int(key[len(PREFIX_UNDO) :].split("_")[0])
+
+
+class TradeIndexer:
+    def __init__(self, db: Rdict, from_block: int | None = None):
+        self.db = db
+        self.from_block = from_block
+        self.synced = False
+        self.listeners = []
+
+    def add_listener(self, listener):
+        """`await listener(events)` after trades are committed, only once synced"""
+        self.listeners.append(listener)
+
+    @property
+    def enabled(self) -> bool:
+        return self.from_block is not None
+
+    def balance(self, holder: str, subject: str) -> int:
+        return self.db.get(f"{PREFIX_HOLDING}{holder}_{subject}", 0)
+
+    def supply(self, subject: str) -> int:
+        return self.db.get(f"{PREFIX_SUPPLY}{subject}", 0)
+
+    def holdings(self, holder: str) -> list[str]:
+        """Subjects holder has shares of"""
+        prefix = f"{PREFIX_HOLDING}{holder}_"
+        subjects = []
+        for k, balance in self.db.items(from_key=prefix):
+            if not k.startswith(prefix):
+                break
+            if balance > 0:
+                subjects.append(k[len(prefix) :])
+        return subjects
+
+    async def run(self):
+        """Index forever, call as a background task"""
+        while True:
+            try:
+                await self.sync()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("trade indexer failed, retrying")
+            await asyncio.sleep(chain.BLOCK_POLL_INTERVAL)
+
+    async def sync(self):
+        """Index every confirmed block not indexed yet"""
+        safe = (await chain.w3.eth.block_number) - INDEX_CONFIRMATIONS
+        trade = chain.contract.events.Trade()
+        checkpoint = self.db.get(KEY_CHECKPOINT, None)
+        if checkpoint is not None and not await self._canonical(checkpoint):
+            await self._rewind(checkpoint["block"])
+            checkpoint = self.db.get(KEY_CHECKPOINT, None)
+        start = self.from_block if checkpoint is None else checkpoint["block"] + 1
+        while start <= safe:
+            end = min(start + INDEX_BATCH_BLOCKS - 1, safe)
+            logs = await chain.w3.eth.get_logs(
+                {
+                    "address": chain.contract.address,
+                    "topics": [event_abi_to_log_topic(trade.abi)],
+                    "fromBlock": start,
+                    "toBlock": end,
+                }
+            )
+            block = await chain.w3.eth.get_block(end)
+            events = [trade.process_log(log) for log in logs]
+            self._apply(events, end, block["hash"].hex())
+            logger.debug("indexed blocks %d-%d, %d trades", start, end, len(logs))
+            start = end + 1
+            # history replayed while catching up is not news
+            if self.synced and len(events) != 0:
+                await self._notify(events)
+        self.synced = True
+
+    async def _notify(self, events: list):
+        for listener in self.listeners:
+            try:
+                await listener(events)
+            except Exception:
+                logger.exception("trade listener %r failed", listener)
+
+    async def _canonical(self, checkpoint: dict) -> bool:
+        if checkpoint["hash"] is None:
+            return True
+        block = await chain.w3.eth.get_block(checkpoint["block"])
+        return block["hash"].hex() == checkpoint["hash"]
+
+    def _apply(self, events: list, end: int, end_hash: str):
+        """Commit the trades of a block range and the new checkpoint atomically"""
+        batch = WriteBatch()
+        pending = {}
+
+        def read(key):
+            return pending[key] if key in pending else self.db.get(key, None)
+
+        def write(key, value, undo):
+            undo.append((key, read(key)))
+            pending[key] = value
+            if value is None:
+                batch.delete(key)
+            else:
+                batch.put(key, value)
+
+        for event in sorted(events, key=lambda e: (e.blockNumber, e.logIndex)):
+            args = event.args
+            undo = []
+            key = f"{PREFIX_HOLDING}{args.trader}_{args.subject}"
+            delta = args.shareAmount if args.isBuy else -args.shareAmount
+            balance = (read(key) or 0) + delta
+            write(key, balance if balance > 0 else None, undo)
+            write(f"{PREFIX_SUPPLY}{args.subject}", args.supply, undo)
+            batch.put(_undo_key(event.blockNumber, event.logIndex), undo)
+
+        # journal older than the reorg window can't be needed anymore
+        oldest = _undo_key(end - INDEX_REORG_WINDOW, 0)
+        for k in self.db.keys(from_key=PREFIX_UNDO):
+            if not k.startswith(PREFIX_UNDO) or k >= oldest:
+                break
+            batch.delete(k)
+
+        batch.put(KEY_CHECKPOINT, {"block": end, "hash": end_hash})
+        self.db.write(batch)
+
+    async def _rewind(self, block: int):
+        """Undo everything indexed after the reorg window below `block`"""
+        target = max(self.from_block - 1, block - INDEX_REORG_WINDOW)
+        logger.warning("reorg below block %d, rewinding to %d", block, target)
+        batch = WriteBatch()
+        restored = {}
+        for k, undo in self.db.items(
+            from_key=_undo_key(block + 1, 0), backwards=True
+        ):
+            if not k.startswith(PREFIX_UNDO) or _undo_block(k) <= target:
+                break
+            for key, value in reversed(undo):
+                restored[key] = value
+            batch.delete(k)
+        for key, value in restored.items():
+            if value is None:
+                batch.delete(key)
+            else:
+                batch.put(key, value)
+        target_hash = None
+        if target >= self.from_block:
+            target_hash = (await chain.w3.eth.get_block(target))["hash"].hex()
+        batch.put(KEY_CHECKPOINT, {"block": target, "hash": target_hash})
+        self.db.write(batch)
+        self.synced = False
+
+
+def create_indexer(db: Rdict) -> TradeIndexer:
+    return TradeIndexer(
+        db, None if INDEX_FROM_BLOCK is None else int(INDEX_FROM_BLOCK)
+    )
@@ -0,0 +1,180 @@
+"""Pools of pre-created invite links per group.
+
+Users are handed a link of their own from the group's pool, so replies never wait on
+`create_chat_invite_link`. A background task tops pools up through a rate-limited
+sender and drops links close to expiring, and a link is revoked once it got its user
+in. Groups get a pool when registered or first asked for, the group's shared link is
+handed out while a pool is empty.
+
+Keys:
+    invite_pool_<chat_id> -> [[link, expire_date], ...] ready to hand out
+"""
+
+import asyncio
+import logging
+import os
+import time
+from collections import Counter
+
+from telegram import Bot, ChatJoinRequest
+from telegram.error import BadRequest, Forbidden, RetryAfter
+
+from sender import RateLimitedSender
+from store import BotStore
+
+# links kept ready per group
+INVITE_POOL_SIZE = int(os.environ.get("INVITE_POOL_SIZE", "5"))
+# seconds a link is valid, links with less than a quarter left are not handed out
+INVITE_LINK_TTL = int(os.environ.get("INVITE_LINK_TTL", "86400"))
+# seconds between pool top-ups when nothing asks for one sooner
+INVITE_REFRESH = float(os.environ.get("INVITE_REFRESH", "60"))
+# max links created or revoked per second
+INVITE_RATE = float(os.environ.get("INVITE_RATE", "1"))
+
+PREFIX_INVITE_POOL = "invite_pool_"
+INVITE_LINK_NAME = "Fans3 invite"
+
+logger = logging.getLogger(__name__)
+
+
+class InviteLinkPool:
+    def __init__(self, store: BotStore, size=INVITE_POOL_SIZE, ttl=INVITE_LINK_TTL):
+        self.store = store
+        self.size = size
+        self.ttl = ttl
+        self.sender = RateLimitedSender(INVITE_RATE)
+        self.bot = None
+        self._pools: dict[int, list] = {}
+        # (chat_id, user_id) -> (link, expire_date) handed out and not used yet
+        self._issued: dict[tuple[int, int], tuple[str, int]] = {}
+        # link -> (chat_id, user_id) it was handed to, links get forwarded
+        self._holders: dict[str, tuple[int, int]] = {}
+        self._creating = Counter()
+        self._wanted = set()
+        self._wake = asyncio.Event()
+        self._task = None
+
+    def load(self):
+        """Load pools, call once on startup"""
+        for k, pool in self.store.range(PREFIX_INVITE_POOL):
+            self._pools[int(k[len(PREFIX_INVITE_POOL) :])] = pool
+
+    def start(self, bot: Bot):
+        self.bot = bot
+        self.sender.start()
+        self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+        self.sender.stop()
+
+    def want(self, chat_id: int):
+        """Create a pool for a group soon"""
+        self._wanted.add(chat_id)
+        self._wake.set()
+
+    def take(self, chat_id: int, user_id: int) -> str | None:
+        """Link of a user to a group, None while the group's pool is empty"""
+        fresh_after = time.time() + self.ttl / 4
+        issued = self._issued.get((chat_id, user_id))
+        if issued is not None and issued[1] > fresh_after:
+            return issued[0]
+        pool = self._pools.get(chat_id)
+        if pool is None or len(pool) < self.size:
+            self.want(chat_id)
+        if not pool:
+            return None
+        while len(pool) != 0:
+            link, expire_date = pool.pop(0)
+            if expire_date > fresh_after:
+                self._drop_issued((chat_id, user_id))
+                self._issued[(chat_id, user_id)] = (link, expire_date)
+                self._holders[link] = (chat_id, user_id)
+                break
+        else:
+            link = None
+        self._save(chat_id)
+        return link
+
+    async def retire(self, request: ChatJoinRequest):
+        """Revoke the pool link a user joined with"""
+        link = request.invite_link
+        if link is None or link.name != INVITE_LINK_NAME:
+            return
+        # whoever it was handed to, they need a new one
+        key = self._holders.get(link.invite_link)
+        if key is not None:
+            self._drop_issued(key)
+        await self.sender.submit(self._revoke, request.chat.id, link.invite_link)
+
+    async def refresh(self):
+        """Drop links close to expiring and top every pool up"""
+        fresh_after = time.time() + self.ttl / 4
+        for key, (_, expire_date) in list(self._issued.items()):
+            if expire_date <= fresh_after:
+                self._drop_issued(key)
+        chat_ids = set(self._pools) | self._wanted
+        self._wanted.clear()
+        for chat_id in chat_ids:
+            pool = self._pools.setdefault(chat_id, [])
+            fresh = [entry for entry in pool if entry[1] > fresh_after]
+            if len(fresh) != len(pool):
+                self._pools[chat_id] = fresh
+                self._save(chat_id)
+            for _ in range(self.size - len(fresh) - self._creating[chat_id]):
+                self._creating[chat_id] += 1
+                await self.sender.submit(self._create, chat_id)
+
+    def _drop_issued(self, key: tuple[int, int]):
+        issued = self._issued.pop(key, None)
+        if issued is not None:
+            self._holders.pop(issued[0], None)
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), INVITE_REFRESH)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            try:
+                await self.refresh()
+            except Exception:
+                logger.exception("failed to refresh invite links")
+
+    async def _create(self, chat_id: int):
+        try:
+            link = await self.bot.create_chat_invite_link(
+                chat_id,
+                name=INVITE_LINK_NAME,
+                creates_join_request=True,
+                expire_date=int(time.time()) + self.ttl,
+            )
+        except RetryAfter:
+            # the sender calls us again once flood control is over
+            raise
+        except (BadRequest, Forbidden):
+            self._creating[chat_id] -= 1
+            # no longer admin, the pool is created again when asked for
+            if chat_id in self._pools:
+                del self._pools[chat_id]
+                self.store.delete(f"{PREFIX_INVITE_POOL}{chat_id}")
+            raise
+        except Exception:
+            # timeouts and network errors, the pool's links are still good and the
+            # next refresh tops it up again
+            self._creating[chat_id] -= 1
+            raise
+        self._creating[chat_id] -= 1
+        self._pools.setdefault(chat_id, []).append(
+            [link.invite_link, int(link.expire_date.timestamp())]
+        )
+        self._save(chat_id)
+
+    async def _revoke(self, chat_id: int, link: str):
+        await self.bot.revoke_chat_invite_link(chat_id, link)
+
+    def _save(self, chat_id: int):
+        if chat_id in self._pools:
+            self.store.set(f"{PREFIX_INVITE_POOL}{chat_id}", self._pools[chat_id])
@@ -0,0 +1,140 @@
+"""python-telegram-bot persistence on the bot's RocksDB.
+
+bot_data, chat_data, user_data and conversation states survive restarts. Updates from
+the application only mark entries dirty; every entry dirtied in the same loop turn is
+written in one `WriteBatch`, so handling an update never waits on the disk.
+
+Keys:
+    ptb_bot                -> bot_data
+    ptb_chat_<chat_id>     -> chat_data of a chat
+    ptb_user_<user_id>     -> user_data of a user
+    ptb_conv_<name>        -> {conversation key: state} of a ConversationHandler
+"""
+
+import asyncio
+import logging
+import os
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+from store import BotStore
+
+# seconds between the application handing changed data to the persistence
+PERSIST_INTERVAL = float(os.environ.get("PERSIST_INTERVAL", "5"))
+
+KEY_BOT_DATA = "ptb_bot"
+PREFIX_CHAT_DATA = "ptb_chat_"
+PREFIX_USER_DATA = "ptb_user_"
+PREFIX_CONVERSATIONS = "ptb_conv_"
+
+logger = logging.getLogger(__name__)
+
+
+class RocksPersistence(BasePersistence):
+    def __init__(self, store: BotStore, update_interval: float = PERSIST_INTERVAL):
+        super().__init__(
+            store_data=PersistenceInput(callback_data=False),
+            update_interval=update_interval,
+        )
+        self.store = store
+        self._conversations: dict[str, dict] = {}
+        # key -> value to write, None to delete
+        self._dirty: dict[str, object] = {}
+        self._flush_task: asyncio.Task | None = None
+
+    def _load(self, prefix: str) -> dict:
+        return {int(k[len(prefix) :]): v for k, v in self.store.range(prefix)}
+
+    async def get_bot_data(self) -> dict:
+        return self.store.get(KEY_BOT_DATA) or {}
+
+    async def get_chat_data(self) -> dict[int, dict]:
+        return self._load(PREFIX_CHAT_DATA)
+
+    async def get_user_data(self) -> dict[int, dict]:
+        return self._load(PREFIX_USER_DATA)
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name: str) -> dict:
+        if name not in self._conversations:
+            self._conversations[name] = (
+                self.store.get(f"{PREFIX_CONVERSATIONS}{name}") or {}
+            )
+        return dict(self._conversations[name])
+
+    async def update_bot_data(self, data: dict):
+        self._mark(KEY_BOT_DATA, data)
+
+    async def update_chat_data(self, chat_id: int, data: dict):
+        self._mark(f"{PREFIX_CHAT_DATA}{chat_id}", data)
+
+    async def update_user_data(self, user_id: int, data: dict):
+        self._mark(f"{PREFIX_USER_DATA}{user_id}", data)
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def update_conversation(self, name: str, key: tuple, new_state: object):
+        conversations = self._conversations.setdefault(name, {})
+        if new_state is None:
+            if conversations.pop(key, None) is None:
+                return
+        elif conversations.get(key) == new_state:
+            return
+        else:
+            conversations[key] = new_state
+        self._mark(f"{PREFIX_CONVERSATIONS}{name}", conversations)
+
+    async def drop_chat_data(self, chat_id: int):
+        self._mark(f"{PREFIX_CHAT_DATA}{chat_id}", None)
+
+    async def drop_user_data(self, user_id: int):
+        self._mark(f"{PREFIX_USER_DATA}{user_id}", None)
+
+    async def refresh_bot_data(self, bot_data: dict):
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict):
+        pass
+
+    async def refresh_user_data(self, user_id: int, user_data: dict):
+        pass
+
+    async def flush(self):
+        """Write what's still dirty, called on shutdown"""
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+        self._write()
+
+    def _mark(self, key: str, value):
+        self._dirty[key] = value
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_soon())
+
+    async def _flush_soon(self):
+        # let the other updates of this round mark their entries first
+        await asyncio.sleep(0)
+        self._flush_task = None
+        try:
+            self._write()
+        except Exception:
+            logger.exception("failed to persist bot data")
+
+    def _write(self):
+        if len(self._dirty) == 0:
+            return
+        dirty, self._dirty = self._dirty, {}
+        try:
+            with self.store.batch() as batch:
+                for key, value in dirty.items():
+                    if value is None:
+                        batch.delete(key)
+                    else:
+                        batch.put(key, value)
+        except Exception:
+            # keep them for the next write, unless changed since
+            self._dirty = {**dirty, **self._dirty}
+            raise
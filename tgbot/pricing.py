@@ -0,0 +1,136 @@
+"""Share prices computed locally from the bonding curve.
+
+`getPrice(supply, amount)` is pure, so a price only depends on the subject's supply and
+the fee percentages. Prices of many subjects come from one supply snapshot: the indexer
+mirror when it's synced, otherwise one multicall of `sharesSupply`. The formula is
+checked against the contract on startup, on any mismatch prices are read over RPC as
+before.
+"""
+
+import logging
+
+from web3 import Web3
+
+import chain
+from indexer import TradeIndexer
+
+ETHER = 10**18
+CURVE_DIVISOR = 16000
+# (supply, amount) compared with the contract's getPrice on startup
+SELF_CHECK_SAMPLES = [
+    (0, 1),
+    (0, 5),
+    (1, 1),
+    (2, 3),
+    (17, 1),
+    (100, 10),
+    (1000, 1),
+    (123456, 7),
+]
+# subjects whose after fee price is compared with the contract on startup
+SELF_CHECK_SUBJECTS = 5
+
+logger = logging.getLogger(__name__)
+
+
+def _sum_of_squares(n: int) -> int:
+    """1^2 + ... + n^2"""
+    return n * (n + 1) * (2 * n + 1) // 6
+
+
+def get_price(supply: int, amount: int) -> int:
+    """Same as the contract's getPrice, in wei"""
+    sum1 = 0 if supply == 0 else _sum_of_squares(supply - 1)
+    sum2 = 0 if supply == 0 and amount == 1 else _sum_of_squares(supply - 1 + amount)
+    return (sum2 - sum1) * ETHER // CURVE_DIVISOR
+
+
+class PriceEngine:
+    def __init__(self, indexer: TradeIndexer):
+        self.indexer = indexer
+        self.local = False
+        self.protocol_fee = None
+        self.subject_fee = None
+
+    async def load(self, subjects: list[str] = ()):
+        """Read fees and check the local formula against the contract, once on startup"""
+        fns = chain.contract.functions
+        block = await chain.w3.eth.block_number
+        self.protocol_fee, self.subject_fee, *expected = await chain.call_many(
+            [fns.protocolFeePercent(), fns.subjectFeePercent()]
+            + [fns.getPrice(supply, amount) for supply, amount in SELF_CHECK_SAMPLES],
+            block,
+        )
+        mismatches = [
+            (sample, price)
+            for sample, price in zip(SELF_CHECK_SAMPLES, expected)
+            if price != get_price(*sample)
+        ]
+        subjects = [Web3.to_checksum_address(s) for s in subjects][
+            :SELF_CHECK_SUBJECTS
+        ]
+        results = await chain.call_many(
+            [fns.sharesSupply(subject) for subject in subjects]
+            + [fns.getBuyPriceAfterFee(subject, 1) for subject in subjects],
+            block,
+        )
+        for subject, supply, price in zip(
+            subjects, results[: len(subjects)], results[len(subjects) :]
+        ):
+            if supply is None or price != self.with_fees(get_price(supply, 1)):
+                mismatches.append((subject, price))
+        self.local = len(mismatches) == 0
+        if not self.local:
+            logger.warning(
+                "local prices differ from the contract %s, reading prices over rpc",
+                mismatches,
+            )
+
+    def with_fees(self, price: int, sell: bool = False) -> int:
+        """Price paid by a buyer, or received by a seller"""
+        fees = price * self.protocol_fee // ETHER + price * self.subject_fee // ETHER
+        return price - fees if sell else price + fees
+
+    async def supplies(self, subjects: list[str]) -> list[int | None]:
+        """Supply of each subject, from one snapshot"""
+        if self.indexer.synced:
+            return [self.indexer.supply(subject) for subject in subjects]
+        return await chain.cached_call_many(
+            [chain.contract.functions.sharesSupply(subject) for subject in subjects]
+        )
+
+    async def buy_prices(
+        self, subjects: list[str], amount: int = 1, after_fee: bool = False
+    ) -> list[int | None]:
+        """Price of buying `amount` shares of each subject, None when it can't be read"""
+        if not self.local:
+            fns = chain.contract.functions
+            fn = fns.getBuyPriceAfterFee if after_fee else fns.getBuyPrice
+            return await chain.cached_call_many(
+                [fn(subject, amount) for subject in subjects]
+            )
+        return [
+            None if supply is None else self._price(supply, amount, after_fee, False)
+            for supply in await self.supplies(subjects)
+        ]
+
+    async def sell_prices(
+        self, subjects: list[str], amount: int = 1, after_fee: bool = False
+    ) -> list[int | None]:
+        """Price of selling `amount` shares of each subject, None past the supply"""
+        if not self.local:
+            fns = chain.contract.functions
+            fn = fns.getSellPriceAfterFee if after_fee else fns.getSellPrice
+            return await chain.cached_call_many(
+                [fn(subject, amount) for subject in subjects]
+            )
+        return [
+            None
+            if supply is None or supply < amount
+            else self._price(supply - amount, amount, after_fee, True)
+            for supply in await self.supplies(subjects)
+        ]
+
+    def _price(self, supply: int, amount: int, after_fee: bool, sell: bool) -> int:
+        price = get_price(supply, amount)
+        return self.with_fees(price, sell) if after_fee else price
@@ -0,0 +1,144 @@
+"""Concurrent update processing that keeps each chat and each user in order.
+
+Up to `UPDATE_CONCURRENCY` updates are handled at once. An update waits for every
+earlier update of its chat and of its user, so a slow handler in one group doesn't hold
+up the others, while conversation state still sees updates in the order they came.
+
+The application hands every queued update to the processor right away, so the update
+queue alone never fills. The webhook reserves a place with `admit` before queueing an
+update, at most `UPDATE_BACKLOG` updates are waiting or running at once.
+"""
+
+import asyncio
+import logging
+import os
+
+from telegram import Update
+from telegram.ext import Application, BaseUpdateProcessor
+
+import chain
+
+# max updates handled at once
+UPDATE_CONCURRENCY = int(os.environ.get("UPDATE_CONCURRENCY", "64"))
+# max admitted updates not handled yet, waiting for their turn or running
+UPDATE_BACKLOG = int(os.environ.get("UPDATE_BACKLOG", "1000"))
+# seconds between queue depth reports
+METRICS_INTERVAL = float(os.environ.get("METRICS_INTERVAL", "60"))
+
+logger = logging.getLogger(__name__)
+
+
+class OrderedUpdateProcessor(BaseUpdateProcessor):
+    def __init__(
+        self,
+        max_concurrent_updates: int = UPDATE_CONCURRENCY,
+        backlog: int = UPDATE_BACKLOG,
+    ):
+        super().__init__(max_concurrent_updates)
+        self.backlog = backlog
+        self._admission = asyncio.Semaphore(backlog)
+        # admitted updates not handled yet
+        self.pending = 0
+        # last update queued per chat and per user, resolved when it's handled
+        self._tails: dict[tuple, asyncio.Future] = {}
+        self.ordering = 0
+        self.active = 0
+        self.processed = 0
+
+    async def admit(self, timeout: float) -> bool:
+        """Reserve a place for an update, False when none frees up within timeout"""
+        try:
+            await asyncio.wait_for(self._admission.acquire(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        self.pending += 1
+        return True
+
+    def release(self):
+        """Give back the place of an admitted update that's done or was never queued"""
+        if self.pending > 0:
+            self.pending -= 1
+            self._admission.release()
+
+    async def process_update(self, update: object, coroutine):
+        # claim our place synchronously, tasks start in the order updates arrived
+        done = asyncio.get_running_loop().create_future()
+        keys = self._keys(update)
+        previous = [self._tails[key] for key in keys if key in self._tails]
+        for key in keys:
+            self._tails[key] = done
+        try:
+            if len(previous) != 0:
+                self.ordering += 1
+                try:
+                    await asyncio.gather(*previous)
+                finally:
+                    self.ordering -= 1
+            await super().process_update(update, coroutine)
+        finally:
+            done.set_result(None)
+            for key in keys:
+                if self._tails.get(key) is done:
+                    del self._tails[key]
+            # polling doesn't admit updates, pending stays 0 there
+            self.release()
+
+    async def do_process_update(self, update: object, coroutine):
+        self.active += 1
+        try:
+            await coroutine
+        finally:
+            self.active -= 1
+            self.processed += 1
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    @staticmethod
+    def _keys(update: object) -> list[tuple]:
+        if not isinstance(update, Update):
+            return []
+        keys = []
+        if update.effective_chat is not None:
+            keys.append(("chat", update.effective_chat.id))
+        if update.effective_user is not None:
+            keys.append(("user", update.effective_user.id))
+        return keys
+
+    def stats(self) -> dict:
+        """Admitted updates, those waiting for earlier ones of their chat or user, and
+        those being handled"""
+        return {
+            "pending": self.pending,
+            "waiting_order": self.ordering,
+            "active": self.active,
+            "processed": self.processed,
+        }
+
+
+def stats(application: Application) -> dict:
+    """Queue depths of the bot, from received updates down to RPCs"""
+    stats = {"update_queue": application.update_queue.qsize()}
+    if isinstance(application.update_processor, OrderedUpdateProcessor):
+        stats.update(application.update_processor.stats())
+    stats.update(chain.rpc_stats())
+    return stats
+
+
+async def report_periodically(application: Application):
+    """Log queue depths, as a warning while every update slot is taken"""
+    while True:
+        await asyncio.sleep(METRICS_INTERVAL)
+        current = stats(application)
+        saturated = (
+            current.get("active", 0)
+            >= application.update_processor.max_concurrent_updates
+        )
+        logger.log(
+            logging.WARNING if saturated else logging.INFO,
+            "queues %s",
+            " ".join(f"{k}={v}" for k, v in current.items()),
+        )
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+"""
+Replay recorded updates against the bot's webhook to measure its throughput offline.
+
+Record updates by running the bot in webhook mode with `RECORD_UPDATES=updates.jsonl`.
+To replay them, run the bot against `fake_bot_api.py`, so handlers don't call Telegram:
+```
+python3 ./fake_bot_api.py --port 8081 --latency 0.05
+TELEGRAM_API_URL=http://127.0.0.1:8081 WEBHOOK_URL=http://127.0.0.1:8443 \
+    WEBHOOK_SECRET=xxx python3 ./tg_bot.py
+python3 ./replay_updates.py updates.jsonl --url http://127.0.0.1:8443/telegram --secret xxx
+```
+Use a copy of `tg.db`, replayed updates change it like real ones.
+"""
+
+import argparse
+import asyncio
+import json
+import time
+from collections import Counter
+
+import aiohttp
+
+
+async def replay(path: str, url: str, secret: str, concurrency: int, repeat: int):
+    updates = [json.loads(line) for line in open(path) if line.strip()]
+    queue = asyncio.Queue()
+    for n in range(repeat):
+        for update in updates:
+            # fresh ids so the bot doesn't treat repeats as duplicates
+            queue.put_nowait({**update, "update_id": update["update_id"] + n * 10**9})
+    statuses = Counter()
+    latencies = []
+    headers = {"X-Telegram-Bot-Api-Secret-Token": secret} if secret else {}
+
+    async def sender(session: aiohttp.ClientSession):
+        while not queue.empty():
+            update = queue.get_nowait()
+            started = time.monotonic()
+            async with session.post(url, json=update, headers=headers) as resp:
+                statuses[resp.status] += 1
+            latencies.append(time.monotonic() - started)
+
+    started = time.monotonic()
+    async with aiohttp.ClientSession() as session:
+        await asyncio.gather(*(sender(session) for _ in range(concurrency)))
+    elapsed = time.monotonic() - started
+
+    latencies.sort()
+    total = len(latencies)
+    print(f"sent {total} updates in {elapsed:.2f}s, {total / elapsed:.1f} updates/s")
+    print(f"status codes: {dict(statuses)}")
+    if total != 0:
+        print(
+            f"latency p50 {latencies[total // 2] * 1000:.1f}ms"
+            f" p99 {latencies[min(total - 1, total * 99 // 100)] * 1000:.1f}ms"
+        )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("path", help="recorded updates, one JSON update per line")
+    parser.add_argument("--url", default="http://127.0.0.1:8443/telegram")
+    parser.add_argument("--secret", default="")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--repeat", type=int, default=1)
+    args = parser.parse_args()
+    asyncio.run(
+        replay(args.path, args.url, args.secret, args.concurrency, args.repeat)
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,205 @@
+"""Web3 provider spreading requests over several RPC endpoints.
+
+Every endpoint keeps an EWMA of its latency and error rate, requests go to the best
+scored one first. When it hasn't answered by its p95 latency the request is hedged to
+the next best endpoint and the first answer wins; a failed endpoint fails over to the
+next one. Errors fade with `error_halflife`, so a recovered endpoint gets traffic back.
+
+Reads are pinned to a block another endpoint reported, an endpoint still behind it
+answers with an error; that counts as a failure and the read fails over too.
+"""
+
+import asyncio
+import logging
+import time
+from collections import deque
+from urllib.parse import urlsplit
+
+import aiohttp
+from web3 import AsyncHTTPProvider
+from web3.providers.async_base import AsyncBaseProvider
+from web3.types import RPCEndpoint, RPCResponse
+
+# methods with side effects are never sent twice
+UNHEDGED_METHODS = {"eth_sendRawTransaction", "eth_sendTransaction"}
+# JSON-RPC error messages of an endpoint that doesn't have the requested block
+UNKNOWN_BLOCK_ERRORS = (
+    "header not found",
+    "unknown block",
+    "block not found",
+    "missing trie node",
+)
+
+logger = logging.getLogger(__name__)
+
+
+class BlockUnavailable(Exception):
+    """The endpoint doesn't have the block a request asked for, it's behind"""
+
+
+def _unknown_block(response) -> str | None:
+    """Error message of a response about a missing block, None for anything else"""
+    error = response.get("error") if isinstance(response, dict) else None
+    if error is None:
+        return None
+    message = str(error.get("message", "") if isinstance(error, dict) else error)
+    return message if any(e in message.lower() for e in UNKNOWN_BLOCK_ERRORS) else None
+
+
+class Endpoint:
+    def __init__(self, url: str, alpha: float, samples: int, error_halflife: float):
+        self.url = url
+        # hosted endpoints carry their API key in the path or query, keep it out of
+        # logs and /healthz
+        parts = urlsplit(url)
+        self.name = f"{parts.scheme}://{parts.hostname}" + (
+            f":{parts.port}" if parts.port else ""
+        )
+        self.provider = AsyncHTTPProvider(url)
+        self.alpha = alpha
+        self.error_halflife = error_halflife
+        self.latency = None
+        self._error_rate = 0.0
+        self._error_at = 0.0
+        self._samples = deque(maxlen=samples)
+
+    @property
+    def error_rate(self) -> float:
+        elapsed = time.monotonic() - self._error_at
+        return self._error_rate * 0.5 ** (elapsed / self.error_halflife)
+
+    def score(self, error_penalty: float) -> float:
+        """Expected seconds to an answer, lower is better, untried endpoints first"""
+        return (self.latency or 0) + self.error_rate * error_penalty
+
+    def p95(self) -> float | None:
+        if len(self._samples) == 0:
+            return None
+        samples = sorted(self._samples)
+        return samples[int(len(samples) * 0.95)]
+
+    def record(self, elapsed: float | None):
+        """Latency of an answer, None for a failure"""
+        failed = 1.0 if elapsed is None else 0.0
+        self._error_rate = (1 - self.alpha) * self.error_rate + self.alpha * failed
+        self._error_at = time.monotonic()
+        if elapsed is None:
+            return
+        self._samples.append(elapsed)
+        self.latency = (
+            elapsed
+            if self.latency is None
+            else (1 - self.alpha) * self.latency + self.alpha * elapsed
+        )
+
+
+class RouterProvider(AsyncBaseProvider):
+    def __init__(
+        self,
+        urls: list[str],
+        alpha: float = 0.2,
+        samples: int = 200,
+        error_halflife: float = 60,
+        error_penalty: float = 10,
+        hedge_min: float = 0.05,
+    ):
+        super().__init__()
+        self.endpoints = [
+            Endpoint(url, alpha, samples, error_halflife) for url in urls
+        ]
+        self.error_penalty = error_penalty
+        self.hedge_min = hedge_min
+
+    async def cache_async_session(self, session: aiohttp.ClientSession):
+        for endpoint in self.endpoints:
+            await endpoint.provider.cache_async_session(session)
+
+    async def is_connected(self, show_traceback: bool = False) -> bool:
+        for endpoint in self.endpoints:
+            if await endpoint.provider.is_connected(show_traceback):
+                return True
+        return False
+
+    def stats(self) -> list[dict]:
+        """Health of every endpoint by its index in the url list, without credentials"""
+        return [
+            {
+                "endpoint": i,
+                "host": endpoint.name,
+                "latency": endpoint.latency,
+                "p95": endpoint.p95(),
+                "error_rate": endpoint.error_rate,
+            }
+            for i, endpoint in enumerate(self.endpoints)
+        ]
+
+    async def make_request(self, method: RPCEndpoint, params) -> RPCResponse:
+        ranked = sorted(self.endpoints, key=lambda e: e.score(self.error_penalty))
+        hedged = method not in UNHEDGED_METHODS
+        pending = {}
+        started = {}
+        error = None
+        won = False
+
+        def launch() -> Endpoint | None:
+            endpoint = ranked.pop(0) if len(ranked) != 0 else None
+            if endpoint is not None:
+                task = asyncio.create_task(self._request(endpoint, method, params))
+                pending[task] = endpoint
+                started[task] = time.monotonic()
+            return endpoint
+
+        last = launch()
+        try:
+            while len(pending) != 0:
+                delay = None
+                if hedged and len(ranked) != 0:
+                    p95 = last.p95()
+                    delay = None if p95 is None else max(p95, self.hedge_min)
+                done, _ = await asyncio.wait(
+                    pending, timeout=delay, return_when=asyncio.FIRST_COMPLETED
+                )
+                if len(done) == 0:
+                    # slower than usual, race the next best endpoint
+                    last = launch() or last
+                    continue
+                for task in done:
+                    endpoint = pending.pop(task)
+                    try:
+                        result = task.result()
+                    except Exception as e:
+                        logger.warning(
+                            "rpc %s on %s failed: %r", method, endpoint.name, e
+                        )
+                        error = e
+                    else:
+                        won = True
+                        return result
+                if len(pending) == 0:
+                    last = launch()
+            raise error
+        finally:
+            now = time.monotonic()
+            for task, endpoint in pending.items():
+                if not task.done():
+                    task.cancel()
+                    # a lost hedge took at least this long, a request abandoned by our
+                    # caller, e.g. on timeout, counts as a failure
+                    endpoint.record(now - started[task] if won else None)
+                elif not task.cancelled():
+                    task.exception()
+
+    async def _request(self, endpoint: Endpoint, method, params) -> RPCResponse:
+        started = time.monotonic()
+        # a cancelled request is recorded by make_request, which knows why it gave up
+        try:
+            response = await endpoint.provider.make_request(method, params)
+        except Exception:
+            endpoint.record(None)
+            raise
+        unknown_block = _unknown_block(response)
+        if unknown_block is not None:
+            endpoint.record(None)
+            raise BlockUnavailable(unknown_block)
+        endpoint.record(time.monotonic() - started)
+        return response
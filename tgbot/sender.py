@@ -0,0 +1,52 @@
+"""Rate-limited worker queue for Telegram API calls.
+
+Jobs are coroutine functions run one at a time, at most `rate` per second. The queue is
+bounded, so producers wait when Telegram can't keep up instead of piling up memory.
+"""
+
+import asyncio
+import logging
+
+from telegram.error import RetryAfter, TelegramError
+
+logger = logging.getLogger(__name__)
+
+
+class RateLimitedSender:
+    def __init__(self, rate: float, max_queue: int = 10000):
+        self.interval = 1 / rate
+        self.queue = asyncio.Queue(maxsize=max_queue)
+        self._worker = None
+
+    async def submit(self, job, *args):
+        """Queue `await job(*args)`, waits while the queue is full"""
+        await self.queue.put((job, args))
+
+    def start(self):
+        self._worker = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self._worker is not None:
+            self._worker.cancel()
+
+    async def _run(self):
+        while True:
+            job, args = await self.queue.get()
+            try:
+                await self._send(job, args)
+            except TelegramError as e:
+                logger.warning("%s%s failed: %r", job.__name__, args, e)
+            except Exception:
+                logger.exception("%s%s failed", job.__name__, args)
+            finally:
+                self.queue.task_done()
+            await asyncio.sleep(self.interval)
+
+    async def _send(self, job, args):
+        while True:
+            try:
+                return await job(*args)
+            except RetryAfter as e:
+                # flood control, Telegram tells us how long to back off
+                logger.info("flood control, retrying in %ss", e.retry_after)
+                await asyncio.sleep(e.retry_after)
@@ -0,0 +1,108 @@
+"""Address recovery for the codes users paste to verify their address.
+
+Codes are `base64(time)|base64(signature)`. Malformed codes are rejected before any
+elliptic-curve work, recovery runs in a process pool capped at `VERIFY_CONCURRENCY`
+so a flood of codes can't stall the event loop, and recovered signatures are
+remembered for as long as a code is valid, so pasting one again costs nothing.
+
+Workers are spawned, they import the bot's main module again, which must not open the
+database or start anything on import. A pool whose worker died is replaced on the next
+code.
+"""
+
+import asyncio
+import base64
+import binascii
+import datetime
+import multiprocessing
+import os
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from eth_account import Account
+from eth_account.messages import encode_defunct
+
+# processes recovering addresses
+VERIFY_WORKERS = int(os.environ.get("VERIFY_WORKERS", "2"))
+# max recoveries queued or running, codes past it are turned away
+VERIFY_CONCURRENCY = int(os.environ.get("VERIFY_CONCURRENCY", "32"))
+# max recovered signatures remembered
+VERIFY_CACHE_SIZE = int(os.environ.get("VERIFY_CACHE_SIZE", "10000"))
+# how long a code is valid
+CODE_TTL = datetime.timedelta(minutes=30)
+SIGNATURE_LENGTH = 65
+
+_pool: ProcessPoolExecutor | None = None
+_slots = asyncio.Semaphore(VERIFY_CONCURRENCY)
+# signature -> (expires, user_id, address or None)
+_recovered = OrderedDict()
+
+
+class Busy(Exception):
+    """Too many recoveries in progress"""
+
+
+def parse_code(code: str) -> tuple[str, datetime.datetime, bytes] | None:
+    """Signed time text, signed time and signature of a code, None if malformed"""
+    parts = code.strip().split("|")
+    if len(parts) != 2:
+        return None
+    try:
+        text = base64.b64decode(parts[0], validate=True).decode()
+        signature = base64.b64decode(parts[1], validate=True)
+        signed_at = datetime.datetime.fromisoformat(text)
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        return None
+    if len(signature) != SIGNATURE_LENGTH or signed_at.tzinfo is None:
+        return None
+    return text, signed_at, signature
+
+
+def _recover(text: str, signature: bytes) -> str | None:
+    try:
+        return Account.recover_message(encode_defunct(text=text), signature=signature)
+    except Exception:
+        return None
+
+
+async def recover(text: str, signature: bytes, user_id: int) -> str | None:
+    """Address that signed text, None if the signature is invalid or already used by
+    another user. Raises Busy when too many recoveries are in progress.
+    """
+    now = time.monotonic()
+    while len(_recovered) != 0 and next(iter(_recovered.values()))[0] < now:
+        _recovered.popitem(last=False)
+    cached = _recovered.get(signature)
+    if cached is not None:
+        _, owner, address = cached
+        return address if owner == user_id else None
+    if _slots.locked():
+        raise Busy()
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(
+            VERIFY_WORKERS, mp_context=multiprocessing.get_context("spawn")
+        )
+    async with _slots:
+        pool = _pool
+        try:
+            address = await asyncio.get_running_loop().run_in_executor(
+                pool, _recover, text, signature
+            )
+        except BrokenProcessPool:
+            # a dead worker breaks the pool for good, start a new one next time
+            if _pool is pool:
+                _pool = None
+                pool.shutdown(wait=False, cancel_futures=True)
+            raise Busy()
+    _recovered[signature] = (now + CODE_TTL.total_seconds(), user_id, address)
+    if len(_recovered) > VERIFY_CACHE_SIZE:
+        _recovered.popitem(last=False)
+    return address
+
+
+def shutdown():
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,240 @@
+"""Repository over the bot's RocksDB.
+
+Related keys are always written together in one `WriteBatch`, so a crash can't leave an
+index entry without the binding it points at. `repair` removes entries orphaned by
+older versions and compacts the database, run it while the bot is stopped.
+
+Keys:
+    chat_addr_<chat_id>           -> address bound to a group
+    addr_chat_<address>_<chat_id> -> chat_id, groups of an address
+    user_addr_<user_id>           -> address verified by a user
+    addr_user_<address>_<user_id> -> user_id, users of an address
+    chat_info_<chat_id>           -> chat json of a registered group
+    chat_link_<chat_id>           -> invite link of a group
+    chat_rec_<chat_id>            -> ChatRecord of a registered group, everything
+                                     listing a group needs in one read
+"""
+
+import json
+import struct
+import time
+from collections import Counter
+from contextlib import contextmanager
+from typing import NamedTuple
+
+from rocksdict import Rdict, WriteBatch
+
+PREFIX_CHAT_ADDRESS = "chat_addr_"
+PREFIX_USER_ADDRESS = "user_addr_"
+PREFIX_CHAT_INFO = "chat_info_"
+PREFIX_CHAT_LINK = "chat_link_"
+PREFIX_ADDRESS_CHATS = "addr_chat_"
+PREFIX_ADDRESS_USERS = "addr_user_"
+PREFIX_CHAT_RECORD = "chat_rec_"
+KEY_MIGRATION_ADDRESS_USERS = "migration_addr_user"
+KEY_MIGRATION_CHAT_RECORDS = "migration_chat_rec"
+
+# updated_at, then byte lengths of address, title and link
+_RECORD_HEADER = struct.Struct(">IHHH")
+
+
+class ChatRecord(NamedTuple):
+    """Denormalized group record, stored in a compact binary encoding"""
+
+    address: str
+    title: str
+    link: str | None
+    updated_at: int
+
+    def encode(self) -> bytes:
+        fields = [f.encode() for f in (self.address, self.title, self.link or "")]
+        return _RECORD_HEADER.pack(
+            self.updated_at, *(len(f) for f in fields)
+        ) + b"".join(fields)
+
+    @classmethod
+    def decode(cls, data: bytes) -> "ChatRecord":
+        updated_at, *lengths = _RECORD_HEADER.unpack_from(data)
+        fields = []
+        offset = _RECORD_HEADER.size
+        for length in lengths:
+            fields.append(data[offset : offset + length].decode())
+            offset += length
+        address, title, link = fields
+        return cls(address, title, link or None, updated_at)
+
+
+class BotStore:
+    def __init__(self, path: str):
+        self.db = Rdict(path)
+
+    def get(self, key: str, default=None):
+        return self.db.get(key, default)
+
+    def set(self, key: str, value):
+        self.db[key] = value
+
+    def delete(self, key: str):
+        self.db.delete(key)
+
+    def range(self, prefix: str):
+        """Iterate (key, value) of every key starting with prefix"""
+        for k, v in self.db.items(from_key=prefix):
+            if not k.startswith(prefix):
+                break
+            yield k, v
+
+    @contextmanager
+    def batch(self):
+        """Collect writes in a WriteBatch, committed at once when the block exits"""
+        batch = WriteBatch()
+        yield batch
+        self.db.write(batch)
+
+    def close(self):
+        self.db.close()
+
+    def bind_chat_address(self, chat_id: int, address: str):
+        old = self.get(f"{PREFIX_CHAT_ADDRESS}{chat_id}")
+        record = self.chat_record(chat_id)
+        with self.batch() as batch:
+            if old is not None and old != address:
+                batch.delete(f"{PREFIX_ADDRESS_CHATS}{old}_{chat_id}")
+            batch.put(f"{PREFIX_CHAT_ADDRESS}{chat_id}", address)
+            batch.put(f"{PREFIX_ADDRESS_CHATS}{address}_{chat_id}", chat_id)
+            if record is not None:
+                self._put_record(batch, chat_id, record._replace(address=address))
+
+    def register_chat(self, chat_id: int, chat_json: str, address: str, title: str):
+        """Store a group whose first share is bought"""
+        record = self.chat_record(chat_id)
+        link = self.get(f"{PREFIX_CHAT_LINK}{chat_id}")
+        with self.batch() as batch:
+            batch.put(f"{PREFIX_CHAT_INFO}{chat_id}", chat_json)
+            self._put_record(
+                batch,
+                chat_id,
+                ChatRecord(address, title, link, 0)
+                if record is None
+                else record._replace(address=address, title=title),
+            )
+
+    def chat_record(self, chat_id: int) -> ChatRecord | None:
+        data = self.get(f"{PREFIX_CHAT_RECORD}{chat_id}")
+        return None if data is None else ChatRecord.decode(data)
+
+    def chat_records(self, chat_ids: list[int]) -> list[ChatRecord | None]:
+        """Records of many groups in one multi-get, None for unknown groups"""
+        if len(chat_ids) == 0:
+            return []
+        values = self.db.get(
+            [f"{PREFIX_CHAT_RECORD}{chat_id}" for chat_id in chat_ids]
+        )
+        return [None if data is None else ChatRecord.decode(data) for data in values]
+
+    def chat_ids_of_address(self, address: str) -> list[int]:
+        """Groups indexed under an address, some may have been rebound since"""
+        return [
+            chat_id for _, chat_id in self.range(f"{PREFIX_ADDRESS_CHATS}{address}_")
+        ]
+
+    def _put_record(self, batch: WriteBatch, chat_id: int, record: ChatRecord):
+        batch.put(
+            f"{PREFIX_CHAT_RECORD}{chat_id}",
+            record._replace(updated_at=int(time.time())).encode(),
+        )
+
+    def chats_of_address(self, address: str) -> list[int]:
+        """Groups bound to an address"""
+        return [
+            chat_id
+            for _, chat_id in self.range(f"{PREFIX_ADDRESS_CHATS}{address}_")
+            if self.get(f"{PREFIX_CHAT_ADDRESS}{chat_id}") == address
+        ]
+
+    def bind_user_address(self, user_id: int, address: str):
+        """Bind a verified address to a user, with its reverse index in the same batch"""
+        old = self.get(f"{PREFIX_USER_ADDRESS}{user_id}")
+        with self.batch() as batch:
+            if old is not None and old != address:
+                batch.delete(f"{PREFIX_ADDRESS_USERS}{old}_{user_id}")
+            batch.put(f"{PREFIX_USER_ADDRESS}{user_id}", address)
+            batch.put(f"{PREFIX_ADDRESS_USERS}{address}_{user_id}", user_id)
+
+    def user_addresses(self, user_ids: list[int]) -> list[str | None]:
+        """Verified addresses of many users in one multi-get, None for unverified"""
+        if len(user_ids) == 0:
+            return []
+        return self.db.get([f"{PREFIX_USER_ADDRESS}{user_id}" for user_id in user_ids])
+
+    def users_of_address(self, address: str) -> list[int]:
+        """Telegram users verified as an address"""
+        return [
+            user_id
+            for _, user_id in self.range(f"{PREFIX_ADDRESS_USERS}{address}_")
+        ]
+
+    def migrate_address_users(self) -> int | None:
+        """Backfill the address to user index for users verified before it existed"""
+        if self.get(KEY_MIGRATION_ADDRESS_USERS) is not None:
+            return None
+        count = 0
+        batch = WriteBatch()
+        for k, address in self.range(PREFIX_USER_ADDRESS):
+            user_id = int(k[len(PREFIX_USER_ADDRESS) :])
+            batch.put(f"{PREFIX_ADDRESS_USERS}{address}_{user_id}", user_id)
+            count += 1
+            if count % 1000 == 0:
+                self.db.write(batch)
+                batch = WriteBatch()
+        batch.put(KEY_MIGRATION_ADDRESS_USERS, count)
+        self.db.write(batch)
+        return count
+
+    def migrate_chat_records(self) -> int | None:
+        """Build records of groups registered before records existed"""
+        if self.get(KEY_MIGRATION_CHAT_RECORDS) is not None:
+            return None
+        count = 0
+        with self.batch() as batch:
+            for k, info in self.range(PREFIX_CHAT_INFO):
+                chat_id = k[len(PREFIX_CHAT_INFO) :]
+                address = self.get(f"{PREFIX_CHAT_ADDRESS}{chat_id}")
+                if address is None:
+                    continue
+                record = ChatRecord(
+                    address,
+                    json.loads(info).get("title") or "Unknown",
+                    self.get(f"{PREFIX_CHAT_LINK}{chat_id}"),
+                    0,
+                )
+                self._put_record(batch, chat_id, record)
+                count += 1
+            batch.put(KEY_MIGRATION_CHAT_RECORDS, count)
+        return count
+
+    def repair(self) -> Counter:
+        """Delete orphaned index entries and compact, returns removed keys per prefix"""
+        removed = Counter()
+        with self.batch() as batch:
+            for prefix, forward in (
+                (PREFIX_ADDRESS_CHATS, PREFIX_CHAT_ADDRESS),
+                (PREFIX_ADDRESS_USERS, PREFIX_USER_ADDRESS),
+            ):
+                for k, owner in self.range(prefix):
+                    address = k[len(prefix) :].rsplit("_", 1)[0]
+                    if self.get(f"{forward}{owner}") != address:
+                        batch.delete(k)
+                        removed[prefix] += 1
+            # info and links of groups that were never bound are unreachable
+            for prefix in (
+                PREFIX_CHAT_INFO,
+                PREFIX_CHAT_LINK,
+                PREFIX_CHAT_RECORD,
+            ):
+                for k, _ in self.range(prefix):
+                    if self.get(f"{PREFIX_CHAT_ADDRESS}{k[len(prefix):]}") is None:
+                        batch.delete(k)
+                        removed[prefix] += 1
+        self.db.compact_range(None, None)
+        return removed
@@ -17,9 +17,17 @@ python3 ./tg_bot.py
 
 Press Ctrl-C on the command line or send a signal to the process to stop the
 bot.
+
+4. To receive updates through a webhook instead of polling, set `WEBHOOK_URL` to the
+public url forwarding to `WEBHOOK_PORT`, and `WEBHOOK_SECRET`, which is required.
+
+5. To clean up orphaned index entries, stop the bot and run
+```
+python3 ./tg_bot.py repair
+```
 """
 
-import logging, os, sys, urllib, json, traceback, base64, datetime, pytz
+import asyncio, functools, itertools, logging, os, sys, urllib, json, traceback, datetime, pytz
 
 MIN_PYTHON = (3, 11)
 if sys.version_info < MIN_PYTHON:
@@ -30,6 +38,7 @@ from typing import Optional, Tuple
 from telegram import (
     Bot,
     Chat,
+    ChatJoinRequest,
     ChatMember,
     ChatMemberUpdated,
     ChatPermissions,
@@ -56,10 +65,26 @@ from telegram.ext import (
 )
 
 from dotenv import load_dotenv
-from web3 import Web3, HTTPProvider
-from eth_account.messages import encode_defunct
-from eth_account import Account
-from rocksdict import Rdict, Options
+from web3 import Web3
+
+import chain
+from batcher import JoinRequestBatcher
+from directory import GroupDirectory
+from indexer import TradeIndexer, create_indexer
+from invites import InviteLinkPool
+from persistence import RocksPersistence
+from pricing import SELF_CHECK_SUBJECTS, PriceEngine
+from processor import OrderedUpdateProcessor, report_periodically
+from sender import RateLimitedSender
+import signatures
+import webhook
+from store import (
+    BotStore,
+    ChatRecord,
+    PREFIX_CHAT_ADDRESS,
+    PREFIX_USER_ADDRESS,
+    PREFIX_CHAT_RECORD,
+)
 
 # add source dir
 # file_dir = os.path.dirname(__file__)
@@ -75,36 +100,31 @@ CALLBACK_CHECK_FIRST_SHARE = "check_first_share"
 CALLBACK_START_VERIFY_ADDRESS = "start_verify_address"
 CALLBACK_CREATE_GROUP = "create_group"
 CALLBACK_CANCEL = "CANCEL"
-PREFIX_CHAT_ADDRESS = "chat_addr_"
-PREFIX_USER_ADDRESS = "user_addr_"
-PREFIX_CHAT_INFO = "chat_info_"
-PREFIX_CHAT_LINK = "chat_link_"
-PREFIX_ADDRESS_CHATS = "addr_chat_"
+CALLBACK_DIRECTORY_PAGE = "directory_page_"
 KEY_BIND_ADDRESS = "bind_address"
-ABI = json.load(open("fans3.json"))
-w3 = Web3(HTTPProvider(os.environ["ETH_RPC"]))
-db = Rdict("tg.db")
-
-
-def db_get(key: str) -> str:
-    return db.get(key, None)
-
-
-def db_set(key: str, value: str):
-    db[key] = value
-    # bytes(value, "utf-8")
-
-
-def db_delete(key: str):
-    db.delete(key)
-
-
-def db_range(start: str, reverse: bool = False):
-    return db.items(from_key=start, backwards=reverse)
-
+KEY_HOLDINGS = "holdings"
+# max characters of a message, Telegram rejects longer ones
+MESSAGE_CHARS = 4096
+# max members removed per second when revoking sold shares
+KICK_RATE = float(os.environ.get("KICK_RATE", "5"))
+# max join requests answered per second
+JOIN_RATE = float(os.environ.get("JOIN_RATE", "10"))
+# seconds between directory price refreshes when trades are not indexed
+DIRECTORY_REFRESH = float(os.environ.get("DIRECTORY_REFRESH", "300"))
+# Bot API server, e.g. fake_bot_api.py to replay updates offline, api.telegram.org if unset
+TELEGRAM_API_URL = os.environ.get("TELEGRAM_API_URL")
+revoke_sender = RateLimitedSender(KICK_RATE)
+join_sender = RateLimitedSender(JOIN_RATE)
+# opened by open_store, spawned signature workers import this module too and must not
+# touch the database
+store: BotStore | None = None
+indexer: TradeIndexer | None = None
+invites: InviteLinkPool | None = None
+price_engine: PriceEngine | None = None
+directory: GroupDirectory | None = None
+# tasks running next to the application, kept out of the persisted bot_data
+background_tasks: dict[str, asyncio.Task] = {}
 
-if ABI == None:
-    logger.error("fans3 abi not found in `fans3.json`")
 
 # Enable logging
 
@@ -154,10 +174,9 @@ async def check_first_share(
     chat: Chat, address: str, context: ContextTypes.DEFAULT_TYPE
 ):
     """Check if group's first share is bought"""
-    contract = w3.eth.contract(
-        address=Web3.to_checksum_address(os.environ["CONTRACT_ADDRESS"]), abi=ABI
+    supply = await chain.cached_call(
+        chain.contract.functions.sharesSupply(Web3.to_checksum_address(address))
     )
-    supply = contract.functions.sharesSupply(Web3.to_checksum_address(address)).call()
     if supply == 0:
         await chat.send_message(
             "Now buy your first share to let others buy and join your group.",
@@ -181,7 +200,9 @@ async def check_first_share(
         )
         return
 
-    db_set(f"{PREFIX_CHAT_INFO}{chat.id}", chat.to_json())
+    store.register_chat(chat.id, chat.to_json(), address, chat.title)
+    invites.want(chat.id)
+    await directory.refresh([chat.id])
     await chat.send_message(
         f"You are all set!\n\nNow your fans can buy your share at {BASE_URL}/tg/buy/{address} to join your group!"
     )
@@ -260,11 +281,8 @@ async def reply_group_address(update: Update, context: ContextTypes.DEFAULT_TYPE
             ),
         )
         return
-    db_set(f"{PREFIX_CHAT_ADDRESS}{update.effective_chat.id}", address)
-    db_set(
-        f"{PREFIX_ADDRESS_CHATS}{address}_{update.effective_chat.id}",
-        update.effective_chat.id,
-    )
+    address = Web3.to_checksum_address(address)
+    store.bind_chat_address(update.effective_chat.id, address)
     del context.chat_data[KEY_BIND_ADDRESS]
     await check_first_share(update.effective_chat, address, context)
 
@@ -294,49 +312,81 @@ async def greet_chat_members(
 
 
 async def verify_join_request(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """receive user join request, checked with the others to the group in a moment"""
+    join_batcher.add(update.chat_join_request)
+
+
+async def verify_join_requests(chat_id: int, requests: list[ChatJoinRequest]):
     """
-    receive use join request
-    1. get tg_user_id
-    2. get user_address by input
-    3. check whether user is accessible
+    check a batch of join requests to a group
+    1. get user addresses in one read
+    2. decline users without a verified address
+    3. approve share holders, read in one multicall, decline the others
     """
-    user = update.chat_join_request.from_user
-    chat = update.chat_join_request.chat
-    address = db_get(f"{PREFIX_USER_ADDRESS}{user.id}")
-    shareHolder = db_get(f"{PREFIX_CHAT_ADDRESS}{chat.id}")
-    if address == None:
-        await context.bot.send_message(
-            chat_id=update.chat_join_request.user_chat_id,
-            text="Join group failed as you don't have a verified address",
-            reply_markup=InlineKeyboardMarkup(
+    shareHolder = store.get(f"{PREFIX_CHAT_ADDRESS}{chat_id}")
+    if shareHolder is None:
+        logger.warning("join requests to unbound group %s", chat_id)
+        return
+    shareHolder = Web3.to_checksum_address(shareHolder)
+    addresses = store.user_addresses([request.from_user.id for request in requests])
+    verified = []
+    for request, address in zip(requests, addresses):
+        if address is None:
+            await join_sender.submit(decline_unverified, request)
+        else:
+            verified.append((request, Web3.to_checksum_address(address)))
+    # the local mirror lags a few blocks, ask the chain before declining a fresh buyer
+    balances = [
+        indexer.balance(address, shareHolder) if indexer.synced else 0
+        for _, address in verified
+    ]
+    unknown = [i for i, balance in enumerate(balances) if balance == 0]
+    results = await chain.cached_call_many(
+        [
+            chain.contract.functions.sharesBalance(shareHolder, verified[i][1])
+            for i in unknown
+        ]
+    )
+    for i, balance in zip(unknown, results):
+        balances[i] = balance or 0
+    for (request, _), balance in zip(verified, balances):
+        if balance > 0:
+            await join_sender.submit(request.approve)
+            await invites.retire(request)
+        else:
+            await join_sender.submit(decline_no_share, request, shareHolder)
+
+
+async def decline_unverified(request: ChatJoinRequest):
+    # user_chat_id only accepts messages while the request is pending, decline last
+    await request.get_bot().send_message(
+        chat_id=request.user_chat_id,
+        text="Join group failed as you don't have a verified address",
+        reply_markup=InlineKeyboardMarkup(
+            [
                 [
-                    [
-                        InlineKeyboardButton(
-                            "Verify your address to continue",
-                            callback_data=CALLBACK_START_VERIFY_ADDRESS,
-                        )
-                    ]
+                    InlineKeyboardButton(
+                        "Verify your address to continue",
+                        callback_data=CALLBACK_START_VERIFY_ADDRESS,
+                    )
                 ]
-            ),
-        )
-        await update.chat_join_request.decline()
-        return
-    contract = w3.eth.contract(
-        address=Web3.to_checksum_address(os.environ["CONTRACT_ADDRESS"]), abi=ABI
+            ]
+        ),
     )
-    balance = contract.functions.sharesBalance(
-        Web3.to_checksum_address(shareHolder), Web3.to_checksum_address(address)
-    ).call()
-    if balance > 0:
-        await update.chat_join_request.approve()
-    else:
-        await context.bot.send_message(
-            chat_id=update.chat_join_request.user_chat_id,
-            text=f"Join group failed as you don't have a share, check your address or click [here]({BASE_URL}/tg/buy/{shareHolder}) to buy a share",
-            parse_mode=ParseMode.MARKDOWN,
-            disable_web_page_preview=True,
-        )
-        await update.chat_join_request.decline()
+    await request.decline()
+
+
+async def decline_no_share(request: ChatJoinRequest, shareHolder: str):
+    await request.get_bot().send_message(
+        chat_id=request.user_chat_id,
+        text=f"Join group failed as you don't have a share, check your address or click [here]({BASE_URL}/tg/buy/{shareHolder}) to buy a share",
+        parse_mode=ParseMode.MARKDOWN,
+        disable_web_page_preview=True,
+    )
+    await request.decline()
+
+
+join_batcher = JoinRequestBatcher(verify_join_requests)
 
 
 async def group_start(
@@ -360,7 +410,7 @@ async def group_start(
         chat.send_message("Permission changed to disallow users to invite others.")
 
     # check if we know group wallet address
-    address = db_get(f"{PREFIX_CHAT_ADDRESS}{chat.id}")
+    address = store.get(f"{PREFIX_CHAT_ADDRESS}{chat.id}")
     if address == None:
         if member_user.status != ChatMemberStatus.OWNER:
             await chat.send_message(
@@ -379,48 +429,74 @@ async def group_start(
     await check_first_share(chat, address, context)
 
 
-async def get_link(chat_id: int, bot: Bot):
-    """Get an invite link for a group"""
-    link = db_get(f"{PREFIX_CHAT_LINK}{chat_id}")
-    if link != None and isinstance(link, str):
-        return link
-    link = (
-        await bot.create_chat_invite_link(
-            chat_id, name="Fans3Bot", creates_join_request=True
+async def get_holdings(address: str, user_id: int) -> str | None:
+    """Get holding groups of an address, with invite links of the user"""
+    address = Web3.to_checksum_address(address)
+    holdings = indexer.holdings(address) if indexer.synced else None
+    if not holdings:
+        holdings = await chain.cached_call(
+            chain.contract.functions.getHoldings(address)
         )
-    ).invite_link
-    if link != None:
-        db_set(f"{PREFIX_CHAT_LINK}{chat_id}", link)
-    return link
-
-
-async def get_holdings(address: str, bot: Bot) -> str | None:
-    """Get holding groups of an address"""
-    contract = w3.eth.contract(
-        address=Web3.to_checksum_address(os.environ["CONTRACT_ADDRESS"]), abi=ABI
-    )
-    holdings = contract.functions.getHoldings(Web3.to_checksum_address(address)).call()
     if holdings == None or len(holdings) == 0:
         return None
+    groups = [
+        (holding, chat_id)
+        for holding in holdings
+        for chat_id in store.chat_ids_of_address(holding)
+    ]
+    # everything we show about the groups in one read
+    records = store.chat_records([chat_id for _, chat_id in groups])
     message = ""
-    for holding in holdings:
-        prefix = f"{PREFIX_ADDRESS_CHATS}{holding}"
-        for k, chat_id in db_range(prefix):
-            if not k.startswith(prefix):
-                break
-            if db_get(f"{PREFIX_CHAT_ADDRESS}{chat_id}") != holding:
-                db_delete(f"{PREFIX_CHAT_ADDRESS}{chat_id}")
-                continue
-            chat = Chat.de_json(json.loads(db_get(f"{PREFIX_CHAT_INFO}{chat_id}")), bot)
-            title = "Unknown"
-            link = "#"
-            if chat != None:
-                title = chat.title
-                link = await get_link(chat.id, bot)
-            message += f"[{title}]({link})({holding})\n"
+    for (holding, chat_id), record in zip(groups, records):
+        # skip unregistered groups and index entries left by a rebinding
+        if record == None or record.address != holding:
+            continue
+        link = invites.take(chat_id, user_id) or record.link
+        if link is None:
+            message += (
+                f"{record.title}({holding}), link on its way, try /start again soon\n"
+            )
+            continue
+        message += f"[{record.title}]({link})({holding})\n"
     return message
 
 
+async def kick_member(bot: Bot, chat_id: int, user_id: int):
+    """Remove a member from a group, they can still join again later"""
+    await bot.ban_chat_member(chat_id, user_id)
+    await bot.unban_chat_member(chat_id, user_id, only_if_banned=True)
+
+
+async def revoke_sold_shares(bot: Bot, events: list):
+    """Remove fans who sold their last share from the groups of that share"""
+    sold = list(
+        {(e.args.trader, e.args.subject) for e in events if not e.args.isBuy}
+    )
+    sold = [
+        (trader, subject)
+        for trader, subject in sold
+        if indexer.balance(trader, subject) == 0
+    ]
+    if len(sold) == 0:
+        return
+    # the mirror trails the head, make sure they didn't buy back since
+    balances = await chain.cached_call_many(
+        [
+            chain.contract.functions.sharesBalance(subject, trader)
+            for trader, subject in sold
+        ]
+    )
+    sold = [pair for pair, balance in zip(sold, balances) if balance == 0]
+    for trader, subject in sold:
+        users = store.users_of_address(trader)
+        if len(users) == 0:
+            continue
+        for chat_id in store.chats_of_address(subject):
+            for user_id in users:
+                logger.info("revoking %s from %s, %s sold", user_id, chat_id, trader)
+                await revoke_sender.submit(kick_member, bot, chat_id, user_id)
+
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """/start command handler"""
     logger.debug(update)
@@ -435,32 +511,26 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
     message = await update.message.reply_text("A moment please...")
-    text = ""
-    contract = w3.eth.contract(
-        address=Web3.to_checksum_address(os.environ["CONTRACT_ADDRESS"]), abi=ABI
-    )
-    address = db_get(f"{PREFIX_USER_ADDRESS}{update.message.from_user.id}")
+    holdings = ""
+    address = store.get(f"{PREFIX_USER_ADDRESS}{update.message.from_user.id}")
     if Web3.is_address(address):
-        text = await get_holdings(address, context.bot)
-        if text == None:
-            text = ""
-        else:
-            text = "\nGroups that you can join:\n" + text
-    group_text = ""
-    for k, info in db_range(PREFIX_CHAT_INFO):
-        if not k.startswith(PREFIX_CHAT_INFO):
-            break
-        chat = Chat.de_json(json.loads(info), context.bot)
-        chat_address = db_get(f"{PREFIX_CHAT_ADDRESS}{chat.id}")
-        price = contract.functions.getBuyPrice(
-            Web3.to_checksum_address(chat_address), 1
-        ).call()
-        priceEth = Web3.from_wei(price, "ether")
-        group_text += f"[{chat.title}]({BASE_URL}/tg/buy/{chat_address}) (`{priceEth} ETH` `{chat_address}`)\n"
+        holdings = await get_holdings(address, update.message.from_user.id)
+        if holdings == None:
+            holdings = ""
+    # kept for the directory pages, so paging doesn't drop the user's groups
+    context.user_data[KEY_HOLDINGS] = holdings
+    text, index, pages = start_text(holdings, 0)
 
-    if len(group_text) != 0:
-        text += "\nKnown groups: (click and buy a share to join)\n" + group_text
+    await message.edit_text(
+        text,
+        parse_mode=ParseMode.MARKDOWN,
+        reply_markup=InlineKeyboardMarkup(start_buttons(address, index, pages)),
+        disable_web_page_preview=True,
+    )
 
+
+def start_buttons(address: str | None, index: int, pages: int) -> list:
+    """Button rows of the /start message showing a directory page"""
     buttons = []
     if Web3.is_address(address):
         buttons.append(
@@ -471,7 +541,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 )
             ]
         )
-    elif len(text) != 0:
+    elif pages != 0:
         buttons.append(
             [
                 InlineKeyboardButton(
@@ -480,24 +550,91 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 )
             ]
         )
+    buttons += directory_buttons(index, pages)
     buttons.append(
         [InlineKeyboardButton("Create a group", callback_data=CALLBACK_CREATE_GROUP)]
     )
     buttons.append([InlineKeyboardButton("Cancel", callback_data=CALLBACK_CANCEL)])
+    return buttons
 
-    if len(text) != 0:
-        text = "Thanks for choosing Fans3, join or create your own group!\n" + text
-    else:
-        text = "Thanks for choosing Fans3, no known group yet, let's create the first group!"
 
-    await message.edit_text(
+def start_text(holdings: str, index: int) -> tuple[str, int, int]:
+    """/start text with a directory page, holdings cut to fit one message"""
+    group_text, index, pages = directory.page(index)
+    if len(holdings) == 0 and len(group_text) == 0:
+        return (
+            "Thanks for choosing Fans3, no known group yet, let's create the first group!",
+            index,
+            pages,
+        )
+    text = "Thanks for choosing Fans3, join or create your own group!\n"
+    if len(group_text) != 0:
+        page = f" ({index + 1}/{pages})" if pages > 1 else ""
+        group_text = (
+            f"\nKnown groups{page}: (click and buy a share to join)\n" + group_text
+        )
+    if len(holdings) != 0:
+        title = "\nGroups that you can join:\n"
+        room = MESSAGE_CHARS - len(text) - len(title) - len(group_text)
+        if len(holdings) > room:
+            more = "...and more groups, too many to list here\n"
+            # cut at a line, a half link would break the markdown
+            holdings = holdings[: holdings.rfind("\n", 0, room - len(more)) + 1] + more
+        text += title + holdings
+    return text + group_text, index, pages
+
+
+def directory_buttons(index: int, pages: int) -> list:
+    """Prev/next buttons of a directory page"""
+    row = []
+    if index > 0:
+        row.append(
+            InlineKeyboardButton(
+                "« Prev", callback_data=f"{CALLBACK_DIRECTORY_PAGE}{index - 1}"
+            )
+        )
+    if index < pages - 1:
+        row.append(
+            InlineKeyboardButton(
+                "Next »", callback_data=f"{CALLBACK_DIRECTORY_PAGE}{index + 1}"
+            )
+        )
+    return [row] if len(row) != 0 else []
+
+
+async def directory_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Show another page of known groups"""
+    query = update.callback_query
+    text, index, pages = start_text(
+        context.user_data.get(KEY_HOLDINGS, ""),
+        int(query.data[len(CALLBACK_DIRECTORY_PAGE) :]),
+    )
+    await query.answer()
+    if pages == 0:
+        return
+    address = store.get(f"{PREFIX_USER_ADDRESS}{query.from_user.id}")
+    await query.edit_message_text(
         text,
         parse_mode=ParseMode.MARKDOWN,
-        reply_markup=InlineKeyboardMarkup(buttons),
+        reply_markup=InlineKeyboardMarkup(start_buttons(address, index, pages)),
         disable_web_page_preview=True,
     )
 
 
+async def refresh_directory(events: list):
+    """Render groups again whose price changed with the trades"""
+    await directory.refresh_subjects({e.args.subject for e in events})
+
+
+async def refresh_directory_periodically():
+    while True:
+        await asyncio.sleep(DIRECTORY_REFRESH)
+        try:
+            await directory.rebuild()
+        except Exception:
+            logger.exception("failed to refresh group directory")
+
+
 async def create_group(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle create request."""
     logger.debug(update)
@@ -528,43 +665,46 @@ async def start_verify_address(
 async def verify_address(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Handle user address binding."""
     logger.debug(update)
-    signatures = update.message.text.split("|")
-    if len(signatures) != 2:
+    code = signatures.parse_code(update.message.text)
+    if code is None:
         await update.message.reply_text(
             "Bad code, please enter a valid one",
             reply_markup=ForceReply(input_field_placeholder="Paste the code here"),
         )
         return STATE_VERIFY_ADDRESS
-    time = str(base64.b64decode(signatures[0]) or b"", "utf-8")
+    time, time_sign, signature = code
     time_now = datetime.datetime.now(pytz.utc)
-    time_sign = datetime.datetime.fromisoformat(time)
     if time_sign >= time_now:
         await update.message.reply_text(
             "Code from future, check your time or try it later",
             reply_markup=ForceReply(input_field_placeholder="Paste the code here"),
         )
         return STATE_VERIFY_ADDRESS
-    elif time_now - datetime.timedelta(minutes=30) > time_sign:
+    elif time_now - signatures.CODE_TTL > time_sign:
         await update.message.reply_text(
             "Code expires, please try again",
             reply_markup=ForceReply(input_field_placeholder="Paste the code here"),
         )
         return STATE_VERIFY_ADDRESS
-    signature = base64.b64decode(signatures[1])
     user = update.message.from_user
-    message = encode_defunct(
-        text=f"Sign this message to allow telegram user\n\n{(user.username or user.full_name or user.first_name)}({str(user.id)})\n\nto join groups that you own a share.\n\nAvailable for 30 minutes.\nTime now: {time}"
-    )
-    address = Account.recover_message(message, signature=signature)
+    message = f"Sign this message to allow telegram user\n\n{(user.username or user.full_name or user.first_name)}({str(user.id)})\n\nto join groups that you own a share.\n\nAvailable for 30 minutes.\nTime now: {time}"
+    try:
+        address = await signatures.recover(message, signature, user.id)
+    except signatures.Busy:
+        await update.message.reply_text(
+            "Too many codes are being checked, please try again in a moment",
+            reply_markup=ForceReply(input_field_placeholder="Paste the code here"),
+        )
+        return STATE_VERIFY_ADDRESS
     logger.debug(f"{time} {time_now} {time_sign} {signature} {message}")
-    db_set(f"{PREFIX_USER_ADDRESS}{update.message.from_user.id}", address)
-    if not Web3.is_address(address):
-        await update.message.edit_message_text(
+    if address is None or not Web3.is_address(address):
+        await update.message.reply_text(
             "Bad code, can not recover your address from code, please enter a valid one",
             reply_markup=ForceReply(input_field_placeholder="Paste the code here"),
         )
         return STATE_VERIFY_ADDRESS
-    holdings = await get_holdings(address, context.bot)
+    store.bind_user_address(user.id, address)
+    holdings = await get_holdings(address, user.id)
     if holdings == None:
         await update.message.reply_text(
             f"You are now {address} but no group share found, use /start to create or join one",
@@ -621,13 +761,98 @@ context.user_data = {str(context.user_data)}
     )
 
 
+async def post_init(application: Application):
+    await chain.open_session()
+    chain.start_block_watcher()
+    background_tasks["metrics"] = asyncio.create_task(
+        report_periodically(application)
+    )
+    join_sender.start()
+    invites.load()
+    invites.start(application.bot)
+    directory.load()
+    try:
+        # a few groups are enough for the check, don't decode them all
+        await price_engine.load(
+            [
+                ChatRecord.decode(data).address
+                for _, data in itertools.islice(
+                    store.range(PREFIX_CHAT_RECORD), SELF_CHECK_SUBJECTS
+                )
+            ]
+        )
+    except Exception:
+        logger.exception("failed to check local prices, reading prices over rpc")
+    if not directory.built:
+        await directory.rebuild()
+    if indexer.enabled:
+        revoke_sender.start()
+        indexer.add_listener(functools.partial(revoke_sold_shares, application.bot))
+        indexer.add_listener(refresh_directory)
+        background_tasks["indexer"] = asyncio.create_task(indexer.run())
+    else:
+        background_tasks["directory"] = asyncio.create_task(
+            refresh_directory_periodically()
+        )
+
+
+async def post_shutdown(application: Application):
+    for task in background_tasks.values():
+        task.cancel()
+    revoke_sender.stop()
+    join_batcher.stop()
+    join_sender.stop()
+    invites.stop()
+    signatures.shutdown()
+    await chain.close_session()
+
+
 # reference & examples
 # https://github.com/python-telegram-bot/python-telegram-bot/blob/master/examples/conversationbot.py
 # https://github.com/python-telegram-bot/rules-bot/blob/af3d63e83b73124cb4b374f9633f1c40fb2ac23d/components/joinrequests.py
+def open_store() -> None:
+    """Open the database and the state kept in it, once per bot process"""
+    global store, indexer, invites, price_engine, directory
+    store = BotStore("tg.db")
+    indexer = create_indexer(store.db)
+    invites = InviteLinkPool(store)
+    price_engine = PriceEngine(indexer)
+    directory = GroupDirectory(store, BASE_URL, price_engine)
+
+
 def main() -> None:
     """Start the bot."""
+    if webhook.WEBHOOK_URL and not webhook.WEBHOOK_SECRET:
+        # anyone who finds the url could post forged updates
+        sys.exit("WEBHOOK_SECRET is required when WEBHOOK_URL is set.")
+    open_store()
+    count = store.migrate_address_users()
+    if count is not None:
+        logger.info("indexed %d user addresses", count)
+    count = store.migrate_chat_records()
+    if count is not None:
+        logger.info("built %d chat records", count)
+
     # Create the Application and pass it your bot's token.
-    application = Application.builder().token(os.environ["TGBOT_KEY"]).build()
+    # handle updates concurrently, in order within each chat and each user
+    builder = (
+        Application.builder()
+        .token(os.environ["TGBOT_KEY"])
+        .concurrent_updates(OrderedUpdateProcessor())
+        .persistence(RocksPersistence(store))
+    )
+    if TELEGRAM_API_URL:
+        builder = builder.base_url(f"{TELEGRAM_API_URL}/bot").base_file_url(
+            f"{TELEGRAM_API_URL}/file/bot"
+        )
+    if webhook.WEBHOOK_URL:
+        # updates come from our own server into a bounded queue, no polling updater
+        builder = builder.updater(None).update_queue(
+            asyncio.Queue(maxsize=webhook.UPDATE_QUEUE_SIZE)
+        )
+    else:
+        builder = builder.post_init(post_init).post_shutdown(post_shutdown)
+    application = builder.build()
 
     # start command for chats and groups
     application.add_handler(CommandHandler("start", start))
@@ -642,6 +867,13 @@ def main() -> None:
         CallbackQueryHandler(cancel, pattern=f"^{CALLBACK_CANCEL}$")
     )
 
+    # browse pages of known groups
+    application.add_handler(
+        CallbackQueryHandler(
+            directory_page, pattern=f"^{CALLBACK_DIRECTORY_PAGE}\\d+$"
+        )
+    )
+
     # check if first group share is bought in groups
     application.add_handler(
         CallbackQueryHandler(start, pattern=f"^{CALLBACK_CHECK_FIRST_SHARE}$")
@@ -659,6 +891,8 @@ def main() -> None:
                 STATE_VERIFY_ADDRESS: [MessageHandler(filters.REPLY, verify_address)]
             },
             fallbacks=[CommandHandler("start", start)],
+            name="verify_address",
+            persistent=True,
         )
     )
 
@@ -687,9 +921,25 @@ def main() -> None:
     # Run the bot until the user presses Ctrl-C
     # We pass 'allowed_updates' handle *all* updates including `chat_member` updates
     # To reset this, simply pass `allowed_updates=[]`
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
-    db.close()
+    if webhook.WEBHOOK_URL:
+        asyncio.run(webhook.run(application, post_init, post_shutdown))
+    else:
+        application.run_polling(allowed_updates=Update.ALL_TYPES)
+    store.close()
+
+
+def repair() -> None:
+    """Remove orphaned index entries, run while the bot is stopped."""
+    open_store()
+    removed = store.repair()
+    for prefix, count in removed.items():
+        logger.info("removed %d orphaned %s keys", count, prefix)
+    logger.info("repair done, removed %d keys", sum(removed.values()))
+    store.close()
 
 
 if __name__ == "__main__":
-    main()
+    if sys.argv[1:] == ["repair"]:
+        repair()
+    else:
+        main()
@@ -0,0 +1,117 @@
+"""Webhook mode for the bot, served by its own ASGI app.
+
+Telegram posts updates to `/telegram`. `WEBHOOK_SECRET` is required, requests without
+it are rejected. An update is only queued once the processor admits it; when
+`UPDATE_BACKLOG` updates are already waiting or running for `WEBHOOK_QUEUE_TIMEOUT`
+seconds the request is answered 503, and Telegram retries later instead of us buffering
+without limit.
+
+Set `RECORD_UPDATES` to a file to append every accepted update as a JSON line, which
+`replay_updates.py` can send again to measure throughput offline, with
+`TELEGRAM_API_URL` pointing at `fake_bot_api.py` in place of Telegram.
+"""
+
+import asyncio
+import hmac
+import json
+import logging
+import os
+
+import uvicorn
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response
+from starlette.routing import Route
+from telegram import Update
+from telegram.ext import Application
+
+import chain
+import processor
+
+# public base url Telegram posts to, webhook mode is on when set
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL")
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET")
+WEBHOOK_LISTEN = os.environ.get("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.environ.get("WEBHOOK_PORT", "8443"))
+# max updates waiting for a handler
+UPDATE_QUEUE_SIZE = int(os.environ.get("UPDATE_QUEUE_SIZE", "1000"))
+# seconds an update may wait for room in the queue before Telegram is told to retry
+WEBHOOK_QUEUE_TIMEOUT = float(os.environ.get("WEBHOOK_QUEUE_TIMEOUT", "5"))
+RECORD_UPDATES = os.environ.get("RECORD_UPDATES")
+
+WEBHOOK_PATH = "/telegram"
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+logger = logging.getLogger(__name__)
+
+
+def create_app(application: Application) -> Starlette:
+    if not WEBHOOK_SECRET:
+        raise RuntimeError("WEBHOOK_SECRET is required in webhook mode")
+    secret = WEBHOOK_SECRET.encode()
+    record = open(RECORD_UPDATES, "a") if RECORD_UPDATES else None
+
+    async def telegram(request: Request) -> Response:
+        # raw header bytes, compare_digest raises TypeError on non-ASCII str
+        token = request.headers.get(SECRET_HEADER, "").encode("latin-1")
+        if not hmac.compare_digest(token, secret):
+            return Response(status_code=403)
+        try:
+            data = await request.json()
+        except ValueError:
+            return Response(status_code=400)
+        update = Update.de_json(data, application.bot)
+        if not await application.update_processor.admit(WEBHOOK_QUEUE_TIMEOUT):
+            logger.warning("update backlog full, asking Telegram to retry")
+            return Response(status_code=503)
+        try:
+            await asyncio.wait_for(
+                application.update_queue.put(update), WEBHOOK_QUEUE_TIMEOUT
+            )
+        except asyncio.TimeoutError:
+            application.update_processor.release()
+            logger.warning("update queue full, asking Telegram to retry")
+            return Response(status_code=503)
+        if record is not None:
+            record.write(json.dumps(data) + "\n")
+        return Response()
+
+    async def healthz(request: Request) -> Response:
+        return JSONResponse(
+            {**processor.stats(application), "rpc": chain.w3.provider.stats()}
+        )
+
+    return Starlette(
+        routes=[
+            Route(WEBHOOK_PATH, telegram, methods=["POST"]),
+            Route("/healthz", healthz, methods=["GET"]),
+        ],
+        on_shutdown=[record.close] if record is not None else [],
+    )
+
+
+async def run(application: Application, post_init=None, post_shutdown=None):
+    """Serve updates through the webhook until the server is stopped"""
+    server = uvicorn.Server(
+        uvicorn.Config(
+            create_app(application),
+            host=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            use_colors=False,
+        )
+    )
+    async with application:
+        if post_init is not None:
+            await post_init(application)
+        await application.bot.set_webhook(
+            url=f"{WEBHOOK_URL}{WEBHOOK_PATH}",
+            allowed_updates=Update.ALL_TYPES,
+            secret_token=WEBHOOK_SECRET,
+        )
+        await application.start()
+        try:
+            await server.serve()
+        finally:
+            await application.stop()
+            if post_shutdown is not None:
+                await post_shutdown(application)
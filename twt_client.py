@@ -0,0 +1,154 @@
+"""Twitter client helpers for fans_server.
+
+tweepy is synchronous, every call is a network round-trip to twitter. `run_twt` runs
+those calls in a bounded thread pool so a slow twitter never blocks the event loop.
+`get_user_api` hands out cached per-user clients sharing one pooled HTTP session, so
+repeat calls reuse warm connections.
+"""
+
+import asyncio
+import functools
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+import tweepy
+from fastapi import HTTPException, status
+
+# max twitter calls in flight per worker, extra calls wait for a free slot
+TWT_MAX_CONCURRENCY = int(os.environ.get("TWT_MAX_CONCURRENCY", "16"))
+# seconds to wait for a slot and then for twitter to answer
+TWT_TIMEOUT = float(os.environ.get("TWT_TIMEOUT", "10"))
+
+_executor = ThreadPoolExecutor(
+    max_workers=TWT_MAX_CONCURRENCY, thread_name_prefix="twt"
+)
+_slots = asyncio.Semaphore(TWT_MAX_CONCURRENCY)
+
+# per-user clients kept around, and for how many seconds
+TWT_CLIENT_CACHE_SIZE = int(os.environ.get("TWT_CLIENT_CACHE_SIZE", "1024"))
+TWT_CLIENT_TTL = float(os.environ.get("TWT_CLIENT_TTL", "3600"))
+
+# one connection pool for every twitter client, auth is applied per request
+_session = requests.Session()
+_session.mount(
+    "https://",
+    requests.adapters.HTTPAdapter(
+        pool_connections=4, pool_maxsize=TWT_MAX_CONCURRENCY
+    ),
+)
+
+
+class _TimeoutAdapter(requests.adapters.HTTPAdapter):
+    """Applies TWT_TIMEOUT to requests sent without a timeout"""
+
+    def send(self, request, timeout=None, **kwargs):
+        return super().send(request, timeout=timeout or TWT_TIMEOUT, **kwargs)
+
+
+class TwtAuth(tweepy.OAuth1UserHandler):
+    """OAuth handler whose handshake requests time out.
+
+    tweepy fetches request and access tokens without a timeout, a hung connection would
+    hold its `run_twt` slot forever. tweepy replaces `oauth` during the handshake, so
+    every session it sets gets the adapter.
+    """
+
+    @property
+    def oauth(self):
+        return self._oauth
+
+    @oauth.setter
+    def oauth(self, session: requests.Session):
+        session.mount("https://", _TimeoutAdapter())
+        self._oauth = session
+
+
+def get_twt_auth(callback: str = None) -> tweepy.OAuth1UserHandler:
+    return TwtAuth(
+        os.environ["CONSUMER_KEY"], os.environ["CONSUMER_SECRET"], callback=callback
+    )
+
+
+def new_api(auth: tweepy.OAuth1UserHandler) -> tweepy.API:
+    """Build a tweepy API on the shared HTTP session"""
+    api = tweepy.API(auth, timeout=TWT_TIMEOUT)
+    api.session = _session
+    return api
+
+
+class ClientCache:
+    """LRU of tweepy clients keyed on the user's access token, entries expire after ttl"""
+
+    def __init__(self, size: int = TWT_CLIENT_CACHE_SIZE, ttl: float = TWT_CLIENT_TTL):
+        self.size = size
+        self.ttl = ttl
+        self._clients = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, ak: str, sk: str) -> tweepy.API:
+        now = time.monotonic()
+        with self._lock:
+            entry = self._clients.get(ak)
+            if entry is not None and entry[0] > now and entry[1] == sk:
+                self._clients.move_to_end(ak)
+                return entry[2]
+        auth = get_twt_auth()
+        auth.set_access_token(ak, sk)
+        api = new_api(auth)
+        with self._lock:
+            self._clients[ak] = (now + self.ttl, sk, api)
+            self._clients.move_to_end(ak)
+            while len(self._clients) > self.size:
+                self._clients.popitem(last=False)
+        return api
+
+    def evict(self, ak: str):
+        with self._lock:
+            self._clients.pop(ak, None)
+
+
+_clients = ClientCache()
+
+
+def get_user_api(ak: str, sk: str) -> tweepy.API:
+    """Cached tweepy client acting as the user owning the access token"""
+    return _clients.get(ak, sk)
+
+
+def _release(future: asyncio.Future):
+    _slots.release()
+    if not future.cancelled():
+        # mark errors of abandoned calls as retrieved
+        future.exception()
+
+
+async def run_twt(func, *args, timeout: float = TWT_TIMEOUT, **kwargs):
+    """Run a blocking tweepy call in the twitter thread pool"""
+    try:
+        await asyncio.wait_for(_slots.acquire(), timeout)
+    except asyncio.TimeoutError:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="too many twitter requests in flight",
+        )
+    loop = asyncio.get_running_loop()
+    try:
+        future = loop.run_in_executor(
+            _executor, functools.partial(func, *args, **kwargs)
+        )
+    except BaseException:
+        _slots.release()
+        raise
+    # a timed out call keeps its thread busy, only free the slot once it really ends
+    future.add_done_callback(_release)
+    try:
+        return await asyncio.wait_for(asyncio.shield(future), timeout)
+    except asyncio.TimeoutError:
+        raise HTTPException(
+            status_code=status.HTTP_504_GATEWAY_TIMEOUT,
+            detail="twitter did not answer in time",
+        )
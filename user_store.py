@@ -0,0 +1,93 @@
+"""User repository for fans_server, indexed by twitter id, screen name and address"""
+
+from storage import Storage
+
+TABLE_USER = "user"
+TABLE_USER_BY_NAME = "user_by_name"
+TABLE_USER_BY_ADDRESS = "user_by_address"
+
+
+def normalize_address(address: str | None) -> str | None:
+    """Case-normalize a wallet address so checksum and lower-case forms match"""
+    if not address:
+        return None
+    return address.strip().lower()
+
+
+def normalize_name(name: str | None) -> str | None:
+    """Twitter screen names are case-insensitive"""
+    if not name:
+        return None
+    return name.strip().lower()
+
+
+class UserStore:
+    """Users keyed by twitter `t_id` with secondary indexes kept in sync on put.
+
+    Indexes live in the same storage as the users and are written in the same batch,
+    so every lookup is a single key read no matter how many users are linked.
+    """
+
+    def __init__(self, storage: Storage, model):
+        self.storage = storage
+        self.model = model
+
+    def values(self, after: str = None):
+        for _, data in self.storage.items(TABLE_USER, after):
+            yield self.model(**data)
+
+    def page(self, after: str = None, limit: int = 100):
+        """Up to `limit` users ordered by key after key `after`, and the key to continue from"""
+        users = []
+        last = None
+        for last, data in self.storage.items(TABLE_USER, after, limit):
+            users.append(self.model(**data))
+        return users, (last if len(users) == limit else None)
+
+    def put(self, user):
+        """Insert or update a user and re-point every index at it"""
+        key = str(user.t_id)
+        with self.storage.batch():
+            old = self.get(user.t_id)
+            if old is not None:
+                self._unindex(old)
+            self.storage.put(TABLE_USER, key, dict(user))
+            name = normalize_name(user.name)
+            if name:
+                self.storage.put(TABLE_USER_BY_NAME, name, key)
+            address = normalize_address(user.address)
+            if address:
+                # last account linked to an address wins
+                self.storage.put(TABLE_USER_BY_ADDRESS, address, key)
+        return user
+
+    def delete(self, t_id: int):
+        with self.storage.batch():
+            user = self.get(t_id)
+            if user is not None:
+                self._unindex(user)
+                self.storage.delete(TABLE_USER, str(t_id))
+        return user
+
+    def get(self, t_id: int | str):
+        data = self.storage.get(TABLE_USER, str(t_id))
+        return None if data is None else self.model(**data)
+
+    def get_by_name(self, name: str):
+        key = normalize_name(name)
+        t_id = key and self.storage.get(TABLE_USER_BY_NAME, key)
+        return None if t_id is None else self.get(t_id)
+
+    def get_by_address(self, address: str):
+        key = normalize_address(address)
+        t_id = key and self.storage.get(TABLE_USER_BY_ADDRESS, key)
+        return None if t_id is None else self.get(t_id)
+
+    def _unindex(self, user):
+        key = str(user.t_id)
+        name = normalize_name(user.name)
+        if name and self.storage.get(TABLE_USER_BY_NAME, name) == key:
+            self.storage.delete(TABLE_USER_BY_NAME, name)
+        address = normalize_address(user.address)
+        if address and self.storage.get(TABLE_USER_BY_ADDRESS, address) == key:
+            self.storage.delete(TABLE_USER_BY_ADDRESS, address)